@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+bench_vmclone.py
+----------------
+Benchmarks vmclone.py against synthetic configuration trees built from the
+samples in test_files/ (ifcfg directories with 1-256 interfaces, hosts files
+of up to 1M lines, long ntp.conf/resolv.conf files and a fake /proc/net/dev
+and /sys/class/net). External commands are stubbed so only vmclone's own
+work is timed.
+
+Results are appended to benchmarks/results.jsonl and compared with the last
+recorded run of a different version/commit so regressions are visible.
+
+Usage:
+# ./benchmarks/bench_vmclone.py [--full] [--repeat N] [--no-save]
+"""
+import subprocess
+import argparse
+import datetime
+import tempfile
+import timeit
+import shutil
+import types
+import json
+import sys
+import os
+
+bench_path = os.path.dirname(os.path.abspath(__file__))
+repo_path = os.path.dirname(bench_path)
+samples = os.path.join(repo_path, 'test_files')
+results_file = os.path.join(bench_path, 'results.jsonl')
+
+# vmclone star-imports its settings on import; provide them in-process
+settings = types.ModuleType('settings')
+settings.domain = 'example.com'
+settings.hosts = '/etc/hosts'
+settings.network = '/etc/sysconfig/network'
+settings.ifcfg_path = '/etc/sysconfig/network-scripts'
+settings.persistent = '/etc/udev/rules.d/70-persistent-net.rules'
+settings.ntpconf = '/etc/ntp.conf'
+settings.resolvconf = '/etc/resolv.conf'
+settings.nameservers = ['192.0.2.%d' % n for n in range(1, 9)]
+settings.ntpservers = ['198.51.100.%d' % n for n in range(1, 9)]  # no lookups
+sys.modules['settings'] = settings
+sys.path.insert(0, repo_path)
+import vmclone  # noqa: E402
+
+# Synthetic tree sizes
+interface_counts = [1, 16, 256]
+hosts_sizes = [10, 1000, 100000]
+hosts_sizes_full = hosts_sizes + [1000000]
+conf_sizes = [10, 1000]
+
+
+class FakeProcess(object):
+    """
+    Stand-in for an external command that completes successfully at once
+    """
+    def __init__(self, command, **kwargs):
+        self.command = command
+        self.returncode = 0
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        return self.returncode
+
+    def kill(self):
+        pass
+
+    def communicate(self, data=None):
+        if os.path.basename(self.command[0]) == 'uuidgen':
+            return '856c2a28-2055-410a-9bd0-6e1bbfdc505a\n', None
+        return '', None
+
+
+def sample(name):
+    with open(os.path.join(samples, name)) as f:
+        return f.read()
+
+
+def mac(n):
+    return '02:00:00:%02x:%02x:%02x' % ((n >> 16) & 0xff, (n >> 8) & 0xff,
+                                        n & 0xff)
+
+
+def build_tree(base, interfaces=1, hosts_lines=10, conf_lines=10):
+    """
+    Build a synthetic system tree and point vmclone's settings at it
+    :param base: empty directory
+    :param interfaces: number of ethX interfaces
+    :param hosts_lines: approximate number of lines in the hosts file
+    :param conf_lines: number of extra lines in ntp.conf/resolv.conf
+    """
+    etc = os.path.join(base, 'etc')
+    scripts = os.path.join(etc, 'sysconfig', 'network-scripts')
+    rules = os.path.join(etc, 'udev', 'rules.d')
+    ssh = os.path.join(etc, 'ssh')
+    sysnet = os.path.join(base, 'sys', 'class', 'net')
+    for d in (scripts, rules, ssh, sysnet, os.path.join(base, 'proc')):
+        os.makedirs(d)
+    template = sample('ifcfg-eth0')
+    netdev = ['Inter-|   Receive                 |  Transmit\n',
+              ' face |bytes    packets errs drop |bytes    packets\n',
+              '    lo:       0       0    0    0        0       0\n']
+    for n in range(interfaces):
+        iface = 'eth%d' % n
+        with open(os.path.join(scripts, 'ifcfg-' + iface), 'w') as f:
+            f.write(template.replace('eth0', iface)
+                    .replace('04:1C:F9:17:7D:B6', mac(n)))
+        netdev.append('%6s:       0       0    0    0        0       0\n'
+                      % iface)
+        os.makedirs(os.path.join(sysnet, iface, 'device'))
+        with open(os.path.join(sysnet, iface, 'address'), 'w') as f:
+            f.write(mac(n) + '\n')
+        with open(os.path.join(sysnet, iface, 'operstate'), 'w') as f:
+            f.write('up\n')
+    with open(os.path.join(base, 'proc', 'net_dev'), 'w') as f:
+        f.writelines(netdev)
+    hosts_sample = sample('hosts-sample')
+    with open(os.path.join(etc, 'hosts'), 'w') as f:
+        f.write(hosts_sample.split('\n\n')[0] + '\n\n')
+        for n in range(max(hosts_lines - 4, 0)):
+            f.write('10.%d.%d.%d\t\thost%d host%d.example.com\n'
+                    % ((n >> 16) & 0xff, (n >> 8) & 0xff, n & 0xff, n, n))
+        f.write(hosts_sample.split('\n\n')[1])
+    with open(os.path.join(etc, 'ntp.conf'), 'w') as f:
+        f.write(sample('ntp-sample'))
+        for n in range(conf_lines):
+            f.write('# restrict %d.%d.0.0 mask 255.255.0.0 nomodify\n'
+                    % (n >> 8, n & 0xff))
+    with open(os.path.join(etc, 'resolv.conf'), 'w') as f:
+        f.write(sample('resolv-sample') + '\n')
+        for n in range(conf_lines):
+            f.write('# options timeout:%d\n' % n)
+    with open(os.path.join(etc, 'sysconfig', 'network'), 'w') as f:
+        f.write(sample('network-sample'))
+    with open(os.path.join(rules, '70-persistent-net.rules'), 'w') as f:
+        f.write(sample('persistent-sample'))
+    with open(os.path.join(etc, 'redhat-release'), 'w') as f:
+        f.write('CentOS release 6.5 (Final)\n')
+    for keytype in ('rsa', 'ecdsa', 'ed25519'):
+        for suffix in ('', '.pub'):
+            with open(os.path.join(ssh, 'ssh_host_%s_key%s'
+                                   % (keytype, suffix)), 'w') as f:
+                f.write('key\n')
+    vmclone.hosts = os.path.join(etc, 'hosts')
+    vmclone.network = os.path.join(etc, 'sysconfig', 'network')
+    vmclone.ifcfg_path = scripts
+    vmclone.persistent = os.path.join(rules, '70-persistent-net.rules')
+    vmclone.ntpconf = os.path.join(etc, 'ntp.conf')
+    vmclone.resolvconf = os.path.join(etc, 'resolv.conf')
+    vmclone.release_file = os.path.join(etc, 'redhat-release')
+    vmclone.sshdir = ssh
+    vmclone.procnetdev = os.path.join(base, 'proc', 'net_dev')
+    vmclone.sysclassnet = sysnet
+    vmclone.backup_root = os.path.join(base, 'cfg_backups')
+    vmclone.fingerprint_file = os.path.join(base, 'vmconf.fingerprint.json')
+    vmclone._interfaces = None
+
+
+def stub_environment():
+    """
+    Replace external commands and kernel state with in-process stand-ins
+    """
+    vmclone.spawn = FakeProcess
+    vmclone.probe_cache_ttl = 0  # time the probes, not the probe cache
+    vmclone.dns_probe = lambda address, timeout: {'rtt': 0.001}
+    vmclone.sntp_probe = lambda address, timeout: {'rtt': 0.001, 'stratum': 2,
+                                                   'offset': 0.0}
+    vmclone.wait_for_interfaces = \
+        lambda expected, timeout=None: dict((i, 0.0) for i in expected)
+
+
+class Benchmark(object):
+    """
+    A benchmark case: a fresh synthetic tree is built for every repetition
+    (and prepared by setup, if given) and only the call itself is timed.
+    """
+    def __init__(self, name, func, setup=None, **tree):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.tree = tree
+
+    def run(self, repeat):
+        timings = []
+        for _ in range(repeat):
+            base = tempfile.mkdtemp(prefix='vmclone-bench-')
+            stdout = sys.stdout
+            try:
+                build_tree(base, **self.tree)
+                sys.stdout = open(os.devnull, 'w')
+                if self.setup:
+                    self.setup(self.tree)
+                start = timeit.default_timer()
+                self.func(self.tree)
+                timings.append(timeit.default_timer() - start)
+            finally:
+                if sys.stdout is not stdout:
+                    sys.stdout.close()
+                    sys.stdout = stdout
+                shutil.rmtree(base)
+        timings.sort()
+        return {'min': timings[0], 'median': timings[len(timings) // 2]}
+
+
+def bench_get_interfaces(tree):
+    vmclone.get_interfaces(refresh=True)
+
+
+def bench_replace(tree):
+    vmclone.replace(vmclone.hosts, '%s%s%s %s.%s\n'
+                    % (vmclone.valip, vmclone.valtabs, 'testserver',
+                       'testserver', 'example.com'),
+                    '192.168.1.99\t\tnewserver newserver.example.com\n')
+
+
+def bench_rewrite_hosts(tree):
+    vmclone.rewrite_hosts(vmclone.hosts,
+                          ['testserver', 'testserver.example.com'],
+                          [('192.168.1.99',
+                            ['newserver', 'newserver.example.com'])])
+
+
+def bench_commit_settings(tree):
+    clone = vmclone.ServerClone()
+    clone.new_serv = 'newserver'
+    for n in range(tree['interfaces']):
+        clone.interfaces['eth%d' % n] = {'ip': '10.%d.%d.10' % (n >> 8,
+                                                                 n & 0xff),
+                                         'nm': '255.255.255.0',
+                                         'gw': '10.%d.%d.1' % (n >> 8,
+                                                               n & 0xff)}
+    clone.apply_settings()
+
+
+def bench_set_ntpservers(tree):
+    vmclone.ServerClone().set_ntpservers()
+
+
+def bench_clean_shutdown(tree):
+    vmclone.clean_shutdown('halt')
+
+
+def benchmarks(full=False):
+    cases = []
+    for n in interface_counts:
+        cases.append(Benchmark('get_interfaces[%d ifaces]' % n,
+                               bench_get_interfaces, interfaces=n))
+    for n in (hosts_sizes_full if full else hosts_sizes):
+        cases.append(Benchmark('replace[hosts %d lines]' % n,
+                               bench_replace, hosts_lines=n))
+        cases.append(Benchmark('rewrite_hosts[hosts %d lines]' % n,
+                               bench_rewrite_hosts, hosts_lines=n))
+    for n in interface_counts:
+        cases.append(Benchmark('commit_settings[%d ifaces]' % n,
+                               bench_commit_settings, interfaces=n))
+    cases.append(Benchmark('commit_settings[hosts %d lines]'
+                           % hosts_sizes[-1], bench_commit_settings,
+                           interfaces=1, hosts_lines=hosts_sizes[-1]))
+    cases.append(Benchmark('commit_settings[unchanged, %d ifaces]'
+                           % interface_counts[-1], bench_commit_settings,
+                           setup=bench_commit_settings,
+                           interfaces=interface_counts[-1]))
+    for n in conf_sizes:
+        cases.append(Benchmark('set_ntpservers[ntp.conf +%d lines]' % n,
+                               bench_set_ntpservers, conf_lines=n))
+    for n in interface_counts:
+        cases.append(Benchmark('clean_shutdown[%d ifaces]' % n,
+                               bench_clean_shutdown, interfaces=n))
+    return cases
+
+
+def git_commit():
+    try:
+        p = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                             cwd=repo_path, stdout=subprocess.PIPE,
+                             stderr=open(os.devnull, 'w'),
+                             universal_newlines=True)
+        return p.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def load_history():
+    history = []
+    if os.path.isfile(results_file):
+        with open(results_file) as f:
+            for line in f:
+                if line.strip():
+                    history.append(json.loads(line))
+    return history
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark vmclone.py')
+    parser.add_argument('--full', action='store_true',
+                        help='include the 1M line hosts file')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='repetitions per benchmark (default: 5)')
+    parser.add_argument('--no-save', action='store_true',
+                        help='do not append the results to %s'
+                             % os.path.relpath(results_file))
+    args = parser.parse_args(argv)
+    stub_environment()
+    run = {'version': vmclone.__version__, 'commit': git_commit(),
+           'date': datetime.datetime.now().isoformat(),
+           'python': sys.version.split()[0], 'results': {}}
+    previous = [h for h in load_history()
+                if (h.get('version'), h.get('commit'))
+                != (run['version'], run['commit'])]
+    previous = previous[-1] if previous else None
+    print('%-45s %12s %12s %10s' % ('benchmark', 'min (ms)', 'median (ms)',
+                                    'vs prev'))
+    for case in benchmarks(args.full):
+        result = case.run(args.repeat)
+        run['results'][case.name] = result
+        change = ''
+        if previous and case.name in previous['results']:
+            before = previous['results'][case.name]['median']
+            if before:
+                ratio = result['median'] / before
+                change = '%.2fx%s' % (ratio, ' !' if ratio > 1.2 else '')
+        print('%-45s %12.3f %12.3f %10s' % (case.name, result['min'] * 1000,
+                                            result['median'] * 1000, change))
+    if previous:
+        print('\nCompared with %s (%s), "!" = more than 20%% slower'
+              % (previous['version'], previous.get('commit')))
+    if not args.no_save:
+        with open(results_file, 'a') as f:
+            f.write(json.dumps(run, sort_keys=True) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -31,3 +31,41 @@ ntpservers = ['0.pool.ntp.org',
               '2.pool.ntp.org',
               '3.pool.ntp.org']
 #### NTP End #
+
+#### Probe Settings #
+probe_timeout = 5  # seconds allowed for each nameserver/ntp probe
+probe_workers = 16  # maximum number of probes running at once
+ready_timeout = 30  # seconds to wait for interfaces after a network restart
+network_reload = 'interfaces'  # 'interfaces' (ifdown/ifup) or 'service'
+probe_cache_ttl = 300  # seconds a probe result is reused (0: always probe)
+probe_cache_shared = None  # directory shared by clones (ie: an NFS export)
+probe_samples = 3  # probes per server; the fastest answer is kept
+probe_keep = 0  # write only the N fastest servers (0: every reachable server)
+write_servers = False  # write reachable servers to resolv.conf and ntp.conf
+#### Probe End #
+
+#### Address Pools (suggested/'auto' addresses per interface) #
+ip_pools = {}  # {'eth0': {'network': '192.168.1.0/24',
+#                          'exclude': ['192.168.1.1-192.168.1.20']}}
+sweep_timeout = 1.0  # seconds to wait for replies to an address sweep
+#### Address Pools End #
+
+#### Offline / Fleet Settings #
+fleet_workers = 4  # guest images re-identified at once by 'fleet'
+#### Offline / Fleet End #
+
+#### First Boot Settings #
+seed_files = ['/mnt/config/vmclone.json']  # firstboot seeds (ie: config drive)
+#### First Boot End #
+
+#### Backup Settings #
+backup_compress = False  # gzip backup blobs (no hardlinked copies)
+#### Backup End #
+
+#### SSH Host Key Settings #
+ssh_host_keys = []  # generated on apply (ie: ['rsa', 'ecdsa', 'ed25519'])
+#### SSH Host Key End #
+
+#### Profile Store Settings #
+# profile_store = '/root/vmclone/profiles.db'  # host profiles (see 'import')
+#### Profile Store End #
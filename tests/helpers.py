@@ -0,0 +1,90 @@
+"""
+helpers.py
+----------
+Shared fixtures for the vmclone tests. vmclone star-imports its settings on
+import, so they are provided in-process (as in benchmarks/bench_vmclone.py),
+and every setting a test overrides is put back afterwards.
+"""
+import tempfile
+import unittest
+import shutil
+import types
+import sys
+import os
+
+tests_path = os.path.dirname(os.path.abspath(__file__))
+repo_path = os.path.dirname(tests_path)
+samples = os.path.join(repo_path, 'test_files')
+
+if 'settings' not in sys.modules:
+    settings = types.ModuleType('settings')
+    settings.domain = 'example.com'
+    settings.hosts = '/etc/hosts'
+    settings.network = '/etc/sysconfig/network'
+    settings.ifcfg_path = '/etc/sysconfig/network-scripts'
+    settings.persistent = '/etc/udev/rules.d/70-persistent-net.rules'
+    settings.ntpconf = '/etc/ntp.conf'
+    settings.resolvconf = '/etc/resolv.conf'
+    settings.nameservers = []
+    settings.ntpservers = []
+    sys.modules['settings'] = settings
+sys.path.insert(0, repo_path)
+import vmclone  # noqa: E402
+
+
+class VmcloneTestCase(unittest.TestCase):
+    """
+    Test case with a scratch directory; settings changed with override()
+    are restored after each test.
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix='vmclone-test-')
+        self.saved = dict()
+        self.override(probe_cache_ttl=0, report=vmclone.RunReport())
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(vmclone, name, value)
+        shutil.rmtree(self.tmp)
+
+    def override(self, **values):
+        """
+        Set vmclone module globals for the duration of the test
+        """
+        for name, value in values.items():
+            self.saved.setdefault(name, getattr(vmclone, name))
+            setattr(vmclone, name, value)
+
+    def build_tree(self, release='CentOS Linux release 7.9.2009 (Core)'):
+        """
+        Copy the sample configuration files (ifcfg-eth0 and ifcfg-eth1
+        included) into the scratch directory and point vmclone's paths at
+        them
+        :param release: content of the release file
+        """
+        etc = os.path.join(self.tmp, 'etc')
+        scripts = os.path.join(etc, 'sysconfig', 'network-scripts')
+        os.makedirs(scripts)
+        paths = {'hosts': os.path.join(etc, 'hosts'),
+                 'network': os.path.join(etc, 'sysconfig', 'network'),
+                 'ntpconf': os.path.join(etc, 'ntp.conf'),
+                 'resolvconf': os.path.join(etc, 'resolv.conf'),
+                 'persistent': os.path.join(etc, '70-persistent-net.rules'),
+                 'release_file': os.path.join(etc, 'redhat-release')}
+        for name, sample in (('hosts', 'hosts-sample'),
+                             ('network', 'network-sample'),
+                             ('ntpconf', 'ntp-sample'),
+                             ('resolvconf', 'resolv-sample'),
+                             ('persistent', 'persistent-sample')):
+            shutil.copy(os.path.join(samples, sample), paths[name])
+        for name in ('ifcfg-eth0', 'ifcfg-eth1'):
+            shutil.copy(os.path.join(samples, name), scripts)
+        with open(paths['release_file'], 'w') as f:
+            f.write(release + '\n')
+        self.override(ifcfg_path=scripts, sshdir=os.path.join(etc, 'ssh'),
+                      backup_root=os.path.join(self.tmp, 'cfg_backups'),
+                      fingerprint_file=os.path.join(self.tmp, 'fp.json'),
+                      ip_index=os.path.join(self.tmp, 'ip_index.json'),
+                      probe_cache=os.path.join(self.tmp, 'probes.json'),
+                      _backup_runs=dict(), **paths)
+        return paths
@@ -0,0 +1,250 @@
+"""
+test_address_pools.py
+---------------------
+Address allocation from ip_pools, with a stub prober in place of the ping
+sweep.
+"""
+import threading
+import unittest
+import socket
+import os
+from time import sleep
+
+from helpers import VmcloneTestCase, vmclone
+
+
+class Prober:
+    """
+    Records the batches checked; addresses in 'used' are reported in use
+    """
+    def __init__(self, used=(), delay=0, error=None):
+        self.used = set(used)
+        self.delay = delay
+        self.error = error
+        self.batches = []
+
+    def __call__(self, addresses):
+        self.batches.append(list(addresses))
+        sleep(self.delay)
+        if self.error:
+            raise socket.error(self.error)
+        return self.used & set(addresses)
+
+
+class PoolAddressesTest(VmcloneTestCase):
+
+    def addresses(self, pool):
+        return [vmclone.int_to_ip(a) for a in vmclone.pool_addresses(pool)]
+
+    def test_network_and_broadcast_skipped(self):
+        found = self.addresses({'network': '10.0.0.0/29'})
+        self.assertEqual(found, ['10.0.0.%d' % i for i in range(1, 7)])
+
+    def test_exclusions(self):
+        found = self.addresses({'network': '10.0.0.0/28',
+                                'exclude': ['10.0.0.9-10.0.0.12', '10.0.0.1',
+                                            '10.0.0.3-10.0.0.4']})
+        self.assertEqual(found, ['10.0.0.2', '10.0.0.5', '10.0.0.6',
+                                 '10.0.0.7', '10.0.0.8', '10.0.0.13',
+                                 '10.0.0.14'])
+
+    def test_overlapping_exclusions(self):
+        found = self.addresses({'network': '10.0.0.0/29',
+                                'exclude': ['10.0.0.2-10.0.0.4',
+                                            '10.0.0.3-10.0.0.5']})
+        self.assertEqual(found, ['10.0.0.1', '10.0.0.6'])
+
+    def test_everything_excluded(self):
+        found = self.addresses({'network': '10.0.0.0/29',
+                                'exclude': ['10.0.0.0/29']})
+        self.assertEqual(found, [])
+
+
+class AllocateAddressTest(VmcloneTestCase):
+
+    def setUp(self):
+        VmcloneTestCase.setUp(self)
+        self.override(ip_index=os.path.join(self.tmp, 'ip_index.json'),
+                      ip_pools={'eth0': {'network': '10.0.0.0/24',
+                                         'exclude': ['10.0.0.1-10.0.0.9']}},
+                      sweep_batch=4)
+
+    def test_first_free_address(self):
+        prober = Prober(used=['10.0.0.10'])
+        self.assertEqual(vmclone.allocate_address('eth0', 'web01', prober),
+                         ('10.0.0.11', '255.255.255.0'))
+        self.assertEqual(vmclone.load_ip_index()['10.0.0.11']['hostname'],
+                         'web01')
+
+    def test_batches(self):
+        prober = Prober(used=['10.0.0.%d' % i for i in range(10, 19)])
+        self.assertEqual(vmclone.allocate_address('eth0', 'web01', prober),
+                         ('10.0.0.19', '255.255.255.0'))
+        self.assertEqual(prober.batches,
+                         [['10.0.0.10', '10.0.0.11', '10.0.0.12',
+                           '10.0.0.13'],
+                          ['10.0.0.14', '10.0.0.15', '10.0.0.16',
+                           '10.0.0.17'],
+                          ['10.0.0.18', '10.0.0.19', '10.0.0.20',
+                           '10.0.0.21']])
+
+    def test_index_entry_reused(self):
+        vmclone.record_addresses('web01', {'eth0': '10.0.0.42'})
+        prober = Prober()
+        self.assertEqual(vmclone.allocate_address('eth0', 'web01', prober),
+                         ('10.0.0.42', '255.255.255.0'))
+        self.assertEqual(prober.batches, [])
+
+    def test_addresses_of_others_skipped(self):
+        vmclone.record_addresses('web01', {'eth0': '10.0.0.10'})
+        prober = Prober()
+        self.assertEqual(vmclone.allocate_address('eth0', 'web02', prober),
+                         ('10.0.0.11', '255.255.255.0'))
+        self.assertNotIn('10.0.0.10', prober.batches[0])
+
+    def test_exhausted(self):
+        self.override(ip_pools={'eth0': {'network': '10.0.0.0/29'}})
+        prober = Prober(used=['10.0.0.%d' % i for i in range(1, 7)])
+        self.assertEqual(vmclone.allocate_address('eth0', 'web01', prober),
+                         None)
+        self.assertFalse(os.path.exists(vmclone.ip_index))
+
+    def test_unchecked_addresses_are_not_allocated(self):
+        prober = Prober(error='Network is unreachable')
+        self.assertEqual(vmclone.allocate_address('eth0', 'web01', prober),
+                         None)
+        self.assertFalse(os.path.exists(vmclone.ip_index))
+
+    def test_sweep_send_failure(self):
+        try:
+            vmclone.ping_sweep(['255.255.255.255'], timeout=0)
+        except socket.error as e:
+            self.assertIn('could not be probed', str(e))
+        else:
+            self.fail('socket.error not raised')
+
+    def test_suggestion_is_not_reserved(self):
+        self.assertEqual(vmclone.allocate_address('eth0', 'web01', Prober(),
+                                                  reserve=False),
+                         ('10.0.0.10', '255.255.255.0'))
+        self.assertEqual(vmclone.load_ip_index(), {})
+
+    def test_concurrent_allocations(self):
+        prober = Prober(delay=0.2)
+        results = dict()
+
+        def allocate(hostname):
+            results[hostname] = vmclone.allocate_address('eth0', hostname,
+                                                         prober)
+        threads = [threading.Thread(target=allocate, args=('web0%d' % i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        addresses = sorted(ip for ip, nm in results.values())
+        self.assertEqual(addresses, ['10.0.0.10', '10.0.0.11', '10.0.0.12',
+                                     '10.0.0.13'])
+        self.assertEqual(sorted(vmclone.load_ip_index()), addresses)
+
+    def test_no_pool(self):
+        self.assertEqual(vmclone.allocate_address('eth1', 'web01', Prober()),
+                         None)
+
+    def test_manifest(self):
+        manifest = {'hostname': 'web01',
+                    'interfaces': {'eth0': {'ip': 'auto'},
+                                   'eth1': {'ip': '10.1.0.5',
+                                            'nm': '255.255.255.0'}}}
+        vmclone.allocate_manifest(manifest, Prober())
+        self.assertEqual(manifest['interfaces']['eth0'],
+                         {'ip': '10.0.0.10', 'nm': '255.255.255.0',
+                          'gw': vmclone.default_gateway('10.0.0.10',
+                                                        '255.255.255.0')})
+        self.assertEqual(manifest['interfaces']['eth1']['ip'], '10.1.0.5')
+
+
+class FleetAllocationTest(VmcloneTestCase):
+
+    def setUp(self):
+        VmcloneTestCase.setUp(self)
+        self.override(ip_index=os.path.join(self.tmp, 'ip_index.json'),
+                      ip_pools={'eth0': {'network': '10.0.0.0/24',
+                                         'exclude': ['10.0.0.1']}},
+                      ping_sweep=Prober(delay=0.1))
+
+    def test_addresses_allocated_before_workers(self):
+        manifests = [{'hostname': 'web0%d' % i,
+                      'root': os.path.join(self.tmp, 'missing'),
+                      'interfaces': {'eth0': {'ip': 'auto'}}}
+                     for i in range(4)]
+        status, code = vmclone.fleet(manifests, workers=4)
+        addresses = [m['interfaces']['eth0']['ip'] for m in manifests]
+        self.assertEqual(addresses, ['10.0.0.2', '10.0.0.3', '10.0.0.4',
+                                     '10.0.0.5'])
+        self.assertEqual(sorted(vmclone.load_ip_index()), addresses)
+        # the roots do not exist: every guest fails after allocation
+        self.assertEqual(code, 1)
+        self.assertEqual(len(status['results']), 4)
+
+    def test_exhausted_pool_is_invalid(self):
+        self.override(ip_pools={'eth0': {'network': '10.0.0.0/29',
+                                         'exclude': ['10.0.0.1-10.0.0.4']}})
+        manifests = [{'hostname': 'web0%d' % i,
+                      'root': os.path.join(self.tmp, 'missing'),
+                      'interfaces': {'eth0': {'ip': 'auto'}}}
+                     for i in range(3)]
+        status, code = vmclone.fleet(manifests)
+        self.assertEqual(code, 2)
+        self.assertIn("web02: eth0: invalid IP address 'auto'",
+                      status['errors'])
+
+
+class ValidateBeforeAllocateTest(VmcloneTestCase):
+
+    def setUp(self):
+        VmcloneTestCase.setUp(self)
+        self.prober = Prober()
+        self.override(ip_index=os.path.join(self.tmp, 'ip_index.json'),
+                      ip_pools={'eth0': {'network': '10.0.0.0/24'}},
+                      _interfaces={'eth0': {'perm_address':
+                                            '04:1c:f9:17:7d:b6'}},
+                      ping_sweep=self.prober, root_prefix=None)
+
+    def test_invalid_batch_is_not_allocated(self):
+        manifest = {'hostname': 'web01', 'prepare': 'shutdown',
+                    'interfaces': {'eth0': {'ip': 'auto'}}}
+        status, code = vmclone.batch(manifest, restart=False)
+        self.assertEqual(code, 2)
+        self.assertEqual(status['errors'],
+                         ["prepare: must be 'halt' or 'reboot'"])
+        self.assertEqual(self.prober.batches, [])
+        self.assertFalse(os.path.exists(vmclone.ip_index))
+
+    def test_invalid_plan_is_not_allocated(self):
+        manifest = {'hostname': 'web01',
+                    'interfaces': {'eth0': {'ip': 'auto',
+                                            'gw': '10.0.0.300'}}}
+        plan, errors = vmclone.compile_plan(manifest)
+        self.assertEqual(plan, None)
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.prober.batches, [])
+        self.assertFalse(os.path.exists(vmclone.ip_index))
+
+    def test_auto_without_pool(self):
+        manifest = {'hostname': 'web01',
+                    'interfaces': {'eth1': {'ip': 'auto'}}}
+        errors = vmclone.validate_plan([manifest], allocate=True)
+        self.assertEqual(len(errors), 1)
+        self.assertIn('no address pool', errors[0])
+
+    def test_auto_with_pool(self):
+        manifest = {'hostname': 'web01',
+                    'interfaces': {'eth0': {'ip': 'auto'}}}
+        self.assertEqual(vmclone.validate_plan([manifest], allocate=True),
+                         [])
+        self.assertNotEqual(vmclone.validate_plan([manifest]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+test_network_reload.py
+----------------------
+Only the interfaces whose ifcfg settings change are cycled after an apply;
+network commands go through a recording ServerClone.runner.
+"""
+import unittest
+
+from helpers import VmcloneTestCase, vmclone
+
+addresses = {'eth0': ('192.168.1.45', '255.255.255.0', '192.168.1.1'),
+             'eth1': ('192.168.20.10', '255.255.255.0', '192.168.20.1')}
+
+
+class NetworkReloadTest(VmcloneTestCase):
+
+    def setUp(self):
+        VmcloneTestCase.setUp(self)
+        self.build_tree()
+        self.override(
+            _interfaces={'eth0': {'perm_address': '04:1c:f9:17:7d:b6'},
+                         'eth1': {'perm_address': '86:0a:cf:89:d7:fe'}},
+            wait_for_interfaces=lambda expected, timeout=None:
+            dict((i, 0.0) for i in expected),
+            network_reload='interfaces', ssh_host_keys=[], ip_pools=dict(),
+            write_servers=False, root_prefix=None)
+        self.commands = []
+        self.ifup_rc = 0
+        self.apply('web01', addresses)
+
+    def runner(self, command):
+        self.commands.append(' '.join(command))
+        return (self.ifup_rc if command[0] == 'ifup' else 0), None
+
+    def apply(self, hostname, interfaces):
+        """
+        Apply a configuration with the recording runner
+        :return: network commands run
+        """
+        clone = vmclone.ServerClone(headless=True)
+        clone.runner = self.runner
+        clone.new_serv = hostname
+        clone.interfaces = dict(
+            (i, {'ip': ip, 'nm': nm, 'gw': gw, 'mac': None})
+            for i, (ip, nm, gw) in interfaces.items())
+        self.commands = []
+        clone.apply_settings()
+        return self.commands
+
+    def test_only_changed_interface(self):
+        changed = dict(addresses)
+        changed['eth1'] = ('192.168.20.11', '255.255.255.0', '192.168.20.1')
+        self.assertEqual(self.apply('web01', changed),
+                         ['ifdown eth1', 'ifup eth1'])
+
+    def test_no_interface_changed(self):
+        self.assertEqual(self.apply('web02', addresses), [])
+
+    def test_no_interface_changed_service_mode(self):
+        self.override(network_reload='service')
+        self.assertEqual(self.apply('web02', addresses), [])
+
+    def test_failed_interface_is_retried(self):
+        changed = dict(addresses)
+        changed['eth0'] = ('192.168.1.46', '255.255.255.0', '192.168.1.1')
+        self.ifup_rc = 1
+        self.assertEqual(self.apply('web01', changed),
+                         ['ifdown eth0', 'ifup eth0'])
+        self.ifup_rc = 0
+        self.assertEqual(self.apply('web01', changed),
+                         ['ifdown eth0', 'ifup eth0'])
+        self.assertEqual(self.apply('web01', changed), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,215 @@
+"""
+test_probes.py
+--------------
+Nameserver/NTP server probes against UDP servers on the loopback network.
+Every stub of a test listens on the same port (its own 127.0.0.x address),
+as the probes use one port per protocol.
+"""
+import threading
+import unittest
+import socket
+import struct
+from time import time
+
+from helpers import VmcloneTestCase, vmclone
+
+
+class UdpStub(threading.Thread):
+    """
+    UDP server answering each datagram with answer(data), silent when it
+    returns None
+    """
+    def __init__(self, address, port, answer=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.answer = answer
+        self.requests = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.sock.settimeout(0.05)
+        self.port = self.sock.getsockname()[1]
+        self.running = True
+
+    def run(self):
+        while self.running:
+            try:
+                data, peer = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            self.requests += 1
+            reply = self.answer(data) if self.answer else None
+            if reply is not None:
+                self.sock.sendto(reply, peer)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        self.sock.close()
+
+
+def dns_answer(rcode=0):
+    """
+    :return: stub answer: the query echoed back as a response
+    """
+    def answer(data):
+        return data[:2] + struct.pack('!H', 0x8180 | rcode) + data[4:]
+    return answer
+
+
+def ntp_answer(stratum=2, flags=0x24, offset=0.0):
+    """
+    :return: stub answer: a server (mode 4) reply to the client request
+    """
+    def answer(data):
+        now = vmclone.ntp_timestamp(time() + offset)
+        return struct.pack('!BB', flags, stratum) + b'\0' * 22 + \
+            data[40:48] + now + now
+    return answer
+
+
+class ProbeTestCase(VmcloneTestCase):
+
+    def setUp(self):
+        VmcloneTestCase.setUp(self)
+        self.stubs = []
+        self.port = None
+
+    def tearDown(self):
+        for stub in self.stubs:
+            stub.stop()
+        VmcloneTestCase.tearDown(self)
+
+    def stub(self, host, answer=None):
+        """
+        Start a stub server on host (the port of the first stub)
+        """
+        stub = UdpStub('127.0.0.%d' % host, self.port or 0, answer)
+        self.port = stub.port
+        self.override(dns_port=self.port, ntp_port=self.port)
+        stub.start()
+        self.stubs.append(stub)
+        return '127.0.0.%d' % host
+
+
+class DnsProbeTest(ProbeTestCase):
+
+    def test_answer(self):
+        server = self.stub(1, dns_answer())
+        result = vmclone.dns_probe(server, 1)
+        self.assertTrue(result)
+        self.assertTrue(0 <= result['rtt'] < 1)
+
+    def test_nxdomain_counts_as_an_answer(self):
+        server = self.stub(1, dns_answer(rcode=3))
+        self.assertTrue(vmclone.dns_probe(server, 1))
+
+    def test_refused(self):
+        server = self.stub(1, dns_answer(rcode=5))
+        self.assertEqual(vmclone.dns_probe(server, 1), None)
+
+    def test_other_query_id_is_ignored(self):
+        def answer(data):
+            qid = struct.unpack('!H', data[:2])[0]
+            return struct.pack('!HH', qid ^ 1, 0x8180) + data[4:]
+        server = self.stub(1, answer)
+        started = time()
+        self.assertEqual(vmclone.dns_probe(server, 0.3), None)
+        self.assertTrue(time() - started >= 0.3)
+
+    def test_silent_server(self):
+        server = self.stub(1)
+        started = time()
+        self.assertEqual(vmclone.dns_probe(server, 0.3), None)
+        self.assertTrue(0.3 <= time() - started < 1)
+        self.assertEqual(self.stubs[0].requests, 1)
+
+
+class SntpProbeTest(ProbeTestCase):
+
+    def test_answer(self):
+        server = self.stub(1, ntp_answer(offset=30))
+        result = vmclone.sntp_probe(server, 1)
+        self.assertEqual(result['stratum'], 2)
+        self.assertTrue(0 <= result['rtt'] < 1)
+        self.assertTrue(29 < result['offset'] < 31)
+
+    def test_kiss_of_death(self):
+        server = self.stub(1, ntp_answer(stratum=0))
+        self.assertEqual(vmclone.sntp_probe(server, 1), None)
+
+    def test_unsynchronized(self):
+        server = self.stub(1, ntp_answer(flags=0xe4))
+        self.assertEqual(vmclone.sntp_probe(server, 1), None)
+
+    def test_client_mode_reply(self):
+        server = self.stub(1, ntp_answer(flags=0x23))
+        self.assertEqual(vmclone.sntp_probe(server, 1), None)
+
+    def test_silent_server(self):
+        server = self.stub(1)
+        started = time()
+        self.assertEqual(vmclone.sntp_probe(server, 0.3), None)
+        self.assertTrue(0.3 <= time() - started < 1)
+
+
+class RunProbesTest(ProbeTestCase):
+
+    def test_dead_server(self):
+        self.override(probe_samples=2, probe_workers=16)
+        servers = [self.stub(1, dns_answer()), self.stub(2),
+                   self.stub(3, dns_answer())]
+        started = time()
+        results = vmclone.run_probes('dns', vmclone.dns_probe, servers,
+                                     timeout=0.5)
+        elapsed = time() - started
+        self.assertEqual([s for s, r in results], servers)
+        self.assertTrue(results[0][1] and results[2][1])
+        self.assertEqual(results[0][1]['samples'], 2)
+        self.assertEqual(results[1][1], None)
+        # the dead server is waited for once, not once per sample
+        self.assertTrue(0.5 <= elapsed < 1.5)
+        self.assertEqual(sorted(p['server'] for p in
+                                vmclone.report.probes), sorted(servers))
+
+    def test_deadline_with_one_worker(self):
+        self.override(probe_samples=1, probe_workers=1)
+        servers = [self.stub(1), self.stub(2), self.stub(3, ntp_answer())]
+        started = time()
+        results = vmclone.run_probes('ntp', vmclone.sntp_probe, servers,
+                                     timeout=0.3)
+        self.assertTrue(time() - started < 0.3 * 3 + 1)
+        self.assertEqual([s for s, r in results], servers)
+        self.assertEqual([bool(r) for s, r in results], [False, False, True])
+
+    def test_unresolvable_server(self):
+        results = vmclone.run_probes('dns', vmclone.dns_probe,
+                                     ['no-such-host.invalid'], timeout=0.3)
+        self.assertEqual(results, [('no-such-host.invalid', None)])
+
+
+class RankServersTest(VmcloneTestCase):
+
+    results = [('10.0.0.1', {'rtt': 0.03}), ('10.0.0.2', None),
+               ('10.0.0.3', {'rtt': 0.01}), ('10.0.0.4', {'rtt': 0.03}),
+               ('10.0.0.5', {'rtt': 0.02})]
+
+    def test_fastest_first(self):
+        self.override(probe_keep=0)
+        self.assertEqual(vmclone.rank_servers(self.results),
+                         ['10.0.0.3', '10.0.0.5', '10.0.0.1', '10.0.0.4'])
+
+    def test_probe_keep(self):
+        self.override(probe_keep=2)
+        self.assertEqual(vmclone.rank_servers(self.results),
+                         ['10.0.0.3', '10.0.0.5'])
+
+    def test_probe_keep_above_reachable(self):
+        self.override(probe_keep=10)
+        self.assertEqual(len(vmclone.rank_servers(self.results)), 4)
+
+    def test_none_reachable(self):
+        self.assertEqual(vmclone.rank_servers([('10.0.0.1', None)]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
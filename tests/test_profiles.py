@@ -0,0 +1,61 @@
+"""
+test_profiles.py
+----------------
+Profile imports checked against the profiles already stored.
+"""
+import unittest
+import os
+
+from helpers import VmcloneTestCase, vmclone
+
+header = 'hostname,interface,mac,ip,nm,gw\n'
+
+
+class ImportProfilesTest(VmcloneTestCase):
+
+    def setUp(self):
+        VmcloneTestCase.setUp(self)
+        self.override(profile_store=os.path.join(self.tmp, 'profiles.db'))
+
+    def import_rows(self, *rows):
+        path = os.path.join(self.tmp, 'fleet.csv')
+        with open(path, 'w') as f:
+            f.write(header + ''.join(row + '\n' for row in rows))
+        return vmclone.import_profiles(path)
+
+    def test_ip_of_a_stored_profile(self):
+        self.assertEqual(self.import_rows(
+            'web01,eth0,52:54:00:12:34:01,192.168.1.45,255.255.255.0,'
+            '192.168.1.1')[1], 0)
+        status, code = self.import_rows(
+            'web02,eth0,52:54:00:12:34:02,192.168.1.45,255.255.255.0,'
+            '192.168.1.1')
+        self.assertEqual(code, 2)
+        self.assertEqual(status['errors'],
+                         ['IP address 192.168.1.45 is assigned more than '
+                          'once: web01: eth0, web02: eth0'])
+
+    def test_mac_of_a_stored_profile(self):
+        self.import_rows('web01,eth0,52:54:00:12:34:01,192.168.1.45,'
+                         '255.255.255.0,192.168.1.1')
+        status, code = self.import_rows(
+            'web02,eth0,52:54:00:12:34:01,192.168.1.46,255.255.255.0,'
+            '192.168.1.1')
+        self.assertEqual(code, 2)
+        self.assertEqual(status['errors'],
+                         ['web02: MAC address 52:54:00:12:34:01 belongs to '
+                          'stored profile web01'])
+
+    def test_replaced_profile_keeps_its_ip(self):
+        self.import_rows('web01,eth0,52:54:00:12:34:01,192.168.1.45,'
+                         '255.255.255.0,192.168.1.1')
+        status, code = self.import_rows(
+            'WEB01,eth0,52:54:00:12:34:01,192.168.1.45,255.255.255.0,'
+            '192.168.1.1',
+            'web02,eth0,52:54:00:12:34:02,192.168.1.46,255.255.255.0,'
+            '192.168.1.1')
+        self.assertEqual((status['status'], code), ('ok', 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+"""
+test_validate_plan.py
+---------------------
+Netmask checks of validate_plan.
+"""
+import unittest
+
+from helpers import VmcloneTestCase, vmclone
+
+
+class NetmaskTest(VmcloneTestCase):
+
+    def errors(self, nm, ip='10.0.0.5', gw='10.0.0.1'):
+        return vmclone.validate_plan([{
+            'hostname': 'web01',
+            'interfaces': {'eth0': {'ip': ip, 'nm': nm, 'gw': gw}}}])
+
+    def test_valid(self):
+        self.assertEqual(self.errors('255.255.255.0'), [])
+
+    def test_point_to_point(self):
+        self.assertEqual(self.errors('255.255.255.254', gw='10.0.0.4'), [])
+
+    def test_not_contiguous(self):
+        self.assertEqual(self.errors('255.0.255.0'),
+                         ["web01: eth0: invalid netmask '255.0.255.0' "
+                          "(not contiguous)"])
+
+    def test_no_network_bits(self):
+        self.assertEqual(self.errors('0.0.0.0'),
+                         ["web01: eth0: invalid netmask '0.0.0.0' "
+                          "(no network bits)"])
+
+
+if __name__ == '__main__':
+    unittest.main()
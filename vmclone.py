@@ -10,33 +10,87 @@ __author__ = 'Blayne Campbell'
 __date__ = '2014-01-29'
 __version__ = '1.2.0'
 
-from time import sleep
+from contextlib import contextmanager
+from time import sleep, time
 import subprocess
+import threading
+import argparse
 import datetime
+import tempfile
+import hashlib
 import shutil
+import socket
+import struct
+import array
+import fcntl
+import atexit
 import json
 import glob
 import sys
 import os
 import re
 
-date = str(datetime.datetime.now().strftime('%Y-%m-%d'))
+# Backup run identifier (see backup_file / restore)
+run_id = '%s-%d' % (datetime.datetime.now().strftime('%Y%m%d-%H%M%S'),
+                    os.getpid())
 
-# Set Working Directory
+# Script Directory (settings, vmconf.json, cfg_backups)
 abspath = os.path.abspath(__file__)
 script_path = os.path.dirname(abspath)
-os.chdir(script_path)
 try:
     from subprocess import DEVNULL  # py3k
 except ImportError:
     DEVNULL = open(os.devnull, 'wb')
+try:
+    from StringIO import StringIO  # py2 (str and unicode)
+except ImportError:
+    from io import StringIO
+
+# Defaults (may be overridden in settings) #
+probe_timeout = 5  # seconds allowed for each nameserver/ntp probe
+probe_workers = 16  # maximum number of probes running at once
+procnetdev = '/proc/net/dev'
+sysclassnet = '/sys/class/net'
+release_file = '/etc/redhat-release'
+sshdir = '/etc/ssh'  # ssh_host_* keys
+backup_root = script_path + '/cfg_backups'
+fleet_workers = 4  # guest images re-identified at once by 'fleet'
+ready_timeout = 30  # seconds to wait for interfaces after a network restart
+backup_compress = False  # gzip backup blobs (no hardlinked copies)
+procnetroute = '/proc/net/route'
+probe_cache = script_path + '/probe_cache.json'
+probe_cache_ttl = 300  # seconds a probe result is reused (0: always probe)
+probe_cache_shared = None  # directory shared by clones (ie: an NFS export)
+probe_samples = 3  # probes per server; the fastest answer is kept
+probe_keep = 0  # write only the N fastest servers (0: every reachable server)
+dns_port = 53
+ntp_port = 123
+proc_cmdline = '/proc/cmdline'
+seed_files = ['/mnt/config/vmclone.json']  # firstboot seeds (ie: config drive)
+firstboot_service = 'vmclone-firstboot'  # systemd unit / SysV init script
+network_reload = 'interfaces'  # 'interfaces' (ifdown/ifup) or 'service'
+write_servers = False  # write reachable servers to resolv.conf and ntp.conf
+procnetarp = '/proc/net/arp'
+ip_pools = dict()  # {'eth0': {'network': '10.0.0.0/24', 'exclude': [..]}}
+ip_index = script_path + '/ip_index.json'  # addresses assigned from pools
+sweep_timeout = 1.0  # seconds to wait for replies to an address sweep
+sweep_batch = 256  # pool addresses checked per sweep
+fingerprint_file = script_path + '/vmconf.fingerprint.json'  # last apply
+ssh_host_keys = []  # host keys generated on apply (ie: ['rsa', 'ed25519'])
+profile_store = script_path + '/profiles.db'  # host profiles (see 'import')
+# Defaults End #
 
 # Import Settings #
+sys.path.insert(0, script_path)
 try:
     from settings import *
 except ImportError:
     sys.exit("Unable to import settings..\n"
              "Try re-naming example-settings.py to settings.py")
+# Relative paths in settings are relative to the script directory
+hosts, network, ifcfg_path, persistent, ntpconf, resolvconf = [
+    os.path.join(script_path, path) for path in
+    (hosts, network, ifcfg_path, persistent, ntpconf, resolvconf)]
 
 
 # Validations #
@@ -46,42 +100,185 @@ valmac = '\\b([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})\\b'
 valproto = '\\b((?i)dhcp|(?i)none)\\b'
 valtabs = '\\b(\\t+)\\b'
 valyesno = '\\b((?i)yes|(?i)no)\\b'
+valip_full = re.compile('^%s$' % valip)
+hostname_pattern = re.compile(r'^HOSTNAME=.*$', re.M)
+valhost = re.compile(r'^(?=.{1,253}$)'
+                     r'[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?'
+                     r'(\.[A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?)*$')
 # Validations End #
 
-# Minimal Mode - Skip all dependency checks
-minimal_mode = 0
-
-
-def dependency_check():
-    """
-    Dependency check for required utilities
-    """
-    # List of applications required by script #
-    all_dependencies = ['nc', 'ntp', 'ntpdate']
-    missing_dependencies = []
-    for dependency in all_dependencies:
-        d = subprocess.Popen(['which', '%s' % dependency], stderr=DEVNULL)
-        if d.wait() != 0:
-            missing_dependencies.append(dependency)
-    if len(missing_dependencies) >= 1:
-        print('The following dependencies are not installed: %s'
-              % " ".join(str(x) for x in missing_dependencies))
-        dep_prompt = raw_input("Would you like to install these now?[y/N]")
-        if dep_prompt.lower() == 'y':
-            for dependency in missing_dependencies:
-                d = subprocess.Popen(['yum', 'install', '%s' % dependency])
-                if d.wait() != 0:
-                    sys.exit("Problem while installing dependency: %s"
-                             % dependency)
-        else:
-            sys.exit('You chose not to install dependencies.. Exiting.')
-    return True
+# ethtool ioctl (linux/sockios.h, linux/ethtool.h)
+SIOCETHTOOL = 0x8946
+ETHTOOL_GPERMADDR = 0x20
+MAX_ADDR_LEN = 32
+SIOCGIFADDR = 0x8915
+
+# Seconds between the NTP (1900) and unix (1970) epochs
+NTP_EPOCH = 2208988800
+
+# Format of the artifacts written by 'plan' (see compile_plan / apply_plan)
+PLAN_VERSION = 1
+
+# Profile store: one row per host, indexed by hostname and by MAC address
+PROFILE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS profiles "
+    "(hostname TEXT PRIMARY KEY COLLATE NOCASE, manifest TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS profile_macs "
+    "(mac TEXT PRIMARY KEY, hostname TEXT NOT NULL COLLATE NOCASE)",
+    "CREATE INDEX IF NOT EXISTS profile_macs_hostname "
+    "ON profile_macs (hostname)")
+PROFILE_COLUMNS = ('hostname', 'interface', 'mac', 'ip', 'nm', 'gw')
+
+# Interface table discovered once per run (see get_interfaces)
+_interfaces = None
+
+# Offline mode: guest filesystem root that settings paths are rebased onto
+root_prefix = None
+_live_paths = None
+
+# Manifest of the current backup run, per backup root (see backup_file)
+_backup_runs = dict()
+
+
+class RunReport:
+    """
+    Run instrumentation: time spent per phase and per external command,
+    process spawns and bytes read/written per managed file.
+    """
+    def __init__(self):
+        self.started = time()
+        self.phases = dict()
+        self.commands = []
+        self.probes = []
+        self.spawns = 0
+        self.files = dict()
+        self.guests = dict()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the run (repeated phases are accumulated)
+        :param name: phase name
+        """
+        start = time()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(name, {'seconds': 0.0, 'calls': 0})
+            entry['seconds'] += time() - start
+            entry['calls'] += 1
+
+    def command(self, command, seconds, returncode):
+        """
+        Record a completed external command
+        """
+        self.commands.append({'command': os.path.basename(command[0]),
+                              'args': list(command[1:]),
+                              'seconds': round(seconds, 6),
+                              'returncode': returncode})
+
+    def probe(self, kind, server, seconds, result):
+        """
+        Record a completed nameserver/NTP server probe
+        """
+        self.probes.append({'kind': kind, 'server': server,
+                            'seconds': round(seconds, 6), 'result': result})
+
+    def io(self, path, read=0, written=0):
+        """
+        Record bytes read from and/or written to a managed file
+        """
+        entry = self.files.setdefault(path, {'read': 0, 'written': 0})
+        entry['read'] += read
+        entry['written'] += written
+
+    def as_dict(self):
+        """
+        :return: report as a JSON serializable dict
+        """
+        phases = dict((k, {'seconds': round(v['seconds'], 6),
+                           'calls': v['calls']})
+                      for k, v in self.phases.items())
+        result = {'version': __version__,
+                  'started': datetime.datetime.fromtimestamp(
+                      self.started).isoformat(),
+                  'elapsed': round(time() - self.started, 6),
+                  'phases': phases,
+                  'commands': self.commands,
+                  'probes': self.probes,
+                  'spawns': self.spawns,
+                  'files': self.files}
+        if self.guests:
+            result['guests'] = self.guests
+        return result
+
+    def save(self, path):
+        """
+        Write the report as JSON
+        :param path: report file
+        """
+        with open(path, 'w') as f:
+            json.dump(self.as_dict(), f, sort_keys=True,
+                      indent=4, separators=(',', ': '))
+
+
+report = RunReport()
+
+
+def spawn(command, **kwargs):
+    """
+    Start an external command. Every process spawn goes through here so it
+    is counted in the run report.
+    :param command: argument list
+    :return: subprocess.Popen object
+    """
+    report.spawns += 1
+    return subprocess.Popen(command, **kwargs)
+
+
+def run_command(command, **kwargs):
+    """
+    Run an external command to completion and record its duration
+    :param command: argument list
+    :return: (return code, output or None)
+    """
+    start = time()
+    p = spawn(command, **kwargs)
+    output = p.communicate()[0]
+    report.command(command, time() - start, p.returncode)
+    return p.returncode, output
+
+
+def read_file(path):
+    """
+    Read a managed file (counted in the run report)
+    :param path: file path
+    :return: file content
+    """
+    with open(path, 'r') as f:
+        content = f.read()
+    report.io(path, read=len(content))
+    return content
+
+
+def write_file(path, content, mode='w'):
+    """
+    Write (or append to) a managed file (counted in the run report)
+    :param path: file path
+    :param content: file content
+    :param mode: 'w' or 'a'
+    """
+    with open(path, mode) as f:
+        f.write(content)
+    report.io(path, written=len(content))
 
 
 def get_release():
-    release = subprocess.Popen(['cat', '/etc/redhat-release'],
-                               stdout=subprocess.PIPE)
-    release = release.stdout.read()
+    try:
+        with open(release_file) as f:
+            release = f.read()
+    except IOError:
+        return False
     release_number = re.match(r'^.*release\s(\d{1,2}).*$', release)
     if release_number:
         return release_number.group(1)
@@ -89,48 +286,200 @@ def get_release():
         return False
 
 
-def get_interfaces():
-    """ Return interface(s) reporting a permanent address via ethtool utility.
+def read_perm_address(sock, interface):
+    """
+    Read the permanent address of an interface in-process via the ethtool
+    ioctl (equivalent of 'ethtool -P <interface>')
+    :param sock: any open AF_INET socket
+    :param interface: interface name (ie: eth0)
+    :return: MAC address (ie: 04:1c:f9:17:7d:b6)
+    """
+    buf = array.array('B', struct.pack('II', ETHTOOL_GPERMADDR,
+                                       MAX_ADDR_LEN) + b'\0' * MAX_ADDR_LEN)
+    ifreq = struct.pack('16sP', interface.encode(), buf.buffer_info()[0])
+    fcntl.ioctl(sock.fileno(), SIOCETHTOOL, ifreq)
+    size = struct.unpack_from('II', buf)[1]
+    return ':'.join('%02x' % b for b in buf[8:8 + size])
+
+
+def read_sys_address(interface):
+    """
+    Read the address of a physical (device backed) interface from sysfs.
+    Used when the ethtool ioctl is unavailable.
+    :param interface: interface name (ie: eth0)
+    :return: MAC address or None for virtual interfaces
+    """
+    sysdir = os.path.join(sysclassnet, interface)
+    if not os.path.exists(os.path.join(sysdir, 'device')):
+        return None
+    try:
+        with open(os.path.join(sysdir, 'address')) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def read_device_description(interface):
+    """
+    Describe the device behind an interface the way udev's write_net_rules
+    does (ie: 'PCI device 0x15ad:0x07b0 (vmxnet3)')
+    :param interface: interface name (ie: eth0)
+    :return: description, or None when sysfs has no device details
+    """
+    device = os.path.join(sysclassnet, interface, 'device')
+    try:
+        with open(os.path.join(device, 'vendor')) as f:
+            vendor = f.read().strip()
+        with open(os.path.join(device, 'device')) as f:
+            product = f.read().strip()
+        driver = os.path.basename(os.readlink(os.path.join(device, 'driver')))
+    except (IOError, OSError):
+        return None
+    return 'PCI device %s:%s (%s)' % (vendor, product, driver)
+
+
+def read_address(sock, interface):
+    """
+    Read the (primary) IPv4 address assigned to an interface in-process
+    :param sock: any open AF_INET socket
+    :param interface: interface name (ie: eth0)
+    :return: IP address, or None when no address is assigned
+    """
+    ifreq = struct.pack('16sH14s', interface.encode(), socket.AF_INET,
+                        b'\0' * 14)
+    try:
+        result = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, ifreq)
+    except (IOError, OSError):
+        return None
+    return socket.inet_ntoa(result[20:24])
+
+
+def read_operstate(interface):
+    """
+    Read the operational state of an interface from sysfs
+    :param interface: interface name (ie: eth0)
+    :return: state (ie: 'up', 'down') or None
+    """
+    try:
+        with open(os.path.join(sysclassnet, interface, 'operstate')) as f:
+            return f.read().strip()
+    except IOError:
+        return None
+
+
+def wait_for_interfaces(expected, timeout=None):
+    """
+    Wait until every interface is up with its expected address assigned, or
+    until the deadline passes.
+    :param expected: dict = {'interface': 'ip'}
+    :param timeout: seconds to wait (default: ready_timeout)
+    :return: dict = {'interface': seconds until ready, or None if not ready}
+    """
+    if timeout is None:
+        timeout = ready_timeout
+    start = time()
+    ready = dict((i, None) for i in expected)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        while True:
+            for i in expected:
+                if ready[i] is None and \
+                        read_operstate(i) in ('up', 'unknown') and \
+                        read_address(sock, i) == expected[i]:
+                    ready[i] = round(time() - start, 3)
+            if None not in ready.values() or time() - start >= timeout:
+                break
+            sleep(0.1)
+    finally:
+        sock.close()
+    for i in sorted(ready):
+        if ready[i] is None:
+            print("Interface %s not ready after %ss" % (i, timeout))
+        else:
+            print("Interface %s ready in %.2fs" % (i, ready[i]))
+    return ready
+
+
+def get_interfaces(refresh=False):
+    """ Return interface(s) reporting a permanent address.
+    Discovery reads /proc/net/dev and queries each interface in-process, once
+    per run; later calls return the cached table.
+    :param refresh: discard the cached table and discover again
+    :return: dict = {'interface': {'perm_address': '00:00:00:00:00:00'}
+    """
+    global _interfaces
+    if _interfaces is not None and not refresh:
+        return _interfaces
+    with report.phase('discover_interfaces'):
+        _interfaces = discover_interfaces()
+    return _interfaces
+
+
+def discover_interfaces():
+    """
+    Discovery pass behind get_interfaces
     :return: dict = {'interface': {'perm_address': '00:00:00:00:00:00'}
     """
-    procnetdev = subprocess.Popen(['cat', '/proc/net/dev'],
-                                  stdout=subprocess.PIPE).stdout.readlines()
     interface_list = []
+    with open(procnetdev) as f:
+        for i in f:
+            if ':' in i:
+                interface_found = i.split(':', 1)[0].strip()
+                if interface_found != 'lo':
+                    interface_list.append(interface_found)
     physical_interfaces = {}
-    for i in procnetdev:
-        iface = re.match(r'^(.*):.*$', i)
-        if iface:
-            interface_found = iface.group(1).strip()
-            if interface_found != 'lo':
-                interface_list.append(interface_found)
-    for interface in interface_list:
-        perm_addr = subprocess.Popen(['ethtool', '-P', interface],
-                                     stdout=subprocess.PIPE,
-                                     stderr=DEVNULL).stdout.readlines()
-        if not perm_addr:
-            continue
-        mac = re.match(r'^Permanent\saddress:\s(.*)$', perm_addr[0])
-        if mac:
-            if mac.group(1) != '00:00:00:00:00:00':
-                physical_interfaces[interface] = {'perm_address': mac.group(1)}
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for interface in interface_list:
+            try:
+                mac = read_perm_address(sock, interface)
+            except (IOError, OSError):
+                mac = read_sys_address(interface)
+            if mac and mac != '00:00:00:00:00:00':
+                physical_interfaces[interface] = {'perm_address': mac}
+    finally:
+        sock.close()
     return physical_interfaces
 
 
+def clear_screen():
+    """
+    Clear the terminal in-process (no 'clear' subprocess)
+    """
+    if sys.stdout.isatty():
+        sys.stdout.write('\033[H\033[2J')
+        sys.stdout.flush()
+
+
+def default_gateway(ip, nm):
+    """
+    Suggested gateway for an address: the first host of its network
+    :param ip: IP address
+    :param nm: netmask
+    :return: gateway IP address
+    """
+    try:
+        import ipaddress
+    except ImportError:  # python 2 without the ipaddress backport
+        return int_to_ip((ip_to_int(ip) & ip_to_int(nm)) + 1)
+    network = ipaddress.ip_network(u'%s/%s' % (ip, nm), strict=False)
+    return str(network.network_address + 1)
+
+
 def show_usage():
     """
-    Show script usage
+    Show script usage: every subcommand (see build_parser)
     """
-    print("\nUsage:\nclone: Re-identify this server (write networking files)")
-    print("check: Show available Name servers and NTP servers\n")
-    sys.exit('Try: %s <check|clone>\n' % sys.argv[0])
+    print('')
+    build_parser().print_help()
+    sys.exit('\nTry: %s <command> --help\n' % sys.argv[0])
 
 
 def current_hostname(lookup):
     """
     Find current hostname of system via /etc/sysconfig/network
     """
-    cur = open(network)
-    cur = cur.readlines()
+    cur = read_file(network).splitlines(True)
     for i in cur:
         if lookup in i:
             host = i.split('=')[1]
@@ -143,187 +492,1774 @@ def current_mac(cfgfile):
     :param cfgfile: interface configuration
     :return: Current MAC address
     """
-    cur = open(cfgfile)
-    cur = cur.readlines()
+    cur = read_file(cfgfile).splitlines(True)
     for i in cur:
         if 'HWADDR' in i:
             return i.strip()[7:]
 
 
-def backup_file(cfgfile):
+def current_uuid(cfgfile):
+    """
+    Find current UUID in given interface configuration
+    :param cfgfile: interface configuration
+    :return: Current UUID, or None
+    """
+    if not os.path.isfile(cfgfile):
+        return None
+    for i in read_file(cfgfile).splitlines():
+        key, sep, value = i.strip().partition('=')
+        if key == 'UUID' and value.strip('"\''):
+            return value.strip('"\'')
+
+
+class Transaction:
+    """
+    Multi-file apply: every new file is staged next to its target and all of
+    them are committed together with atomic renames. Staged files are
+    fsynced in one batch before renaming and each directory is fsynced once
+    afterwards. Aborting only removes the staged files; targets are never
+    written twice or left half-written.
+
+    with Transaction() as txn:
+        txn.stage('/etc/hosts', content)
+    """
+    def __init__(self):
+        self.staged = dict()  # target: (temporary file, open file object)
+        self.order = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+
+    def open(self, path, mode=None, binary=False):
+        """
+        Stage a file to be written incrementally
+        :param path: target file
+        :param mode: permission bits (default: those of the existing target)
+        :param binary: open the staged file in binary mode
+        :return: writable file object (left open until commit/rollback)
+        """
+        path = os.path.abspath(path)
+        if path in self.staged:
+            self.discard(path)
+        directory, name = os.path.split(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(prefix='.%s.' % name, dir=directory)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        elif os.path.exists(path):
+            shutil.copymode(path, tmp)
+        else:
+            os.chmod(tmp, 0o644)
+        f = os.fdopen(fd, 'wb' if binary else 'w')
+        self.staged[path] = (tmp, f)
+        self.order.append(path)
+        return f
+
+    def stage(self, path, content, mode=None):
+        """
+        Stage the complete new content of a file
+        :param path: target file
+        :param content: new content (str or bytes)
+        :param mode: permission bits (default: those of the existing target)
+        """
+        f = self.open(path, mode, binary=not isinstance(content, str))
+        f.write(content)
+        report.io(path, written=len(content))
+
+    def discard(self, path):
+        """
+        Drop a staged file
+        """
+        tmp, f = self.staged.pop(path)
+        self.order.remove(path)
+        f.close()
+        os.remove(tmp)
+
+    def commit(self):
+        """
+        fsync all staged files, rename them over their targets, then fsync
+        each directory once
+        """
+        with report.phase('commit'):
+            for path in self.order:
+                f = self.staged[path][1]
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+            directories = []
+            for path in self.order:
+                os.rename(self.staged[path][0], path)
+                if os.path.dirname(path) not in directories:
+                    directories.append(os.path.dirname(path))
+            for directory in directories:
+                fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            self.staged = dict()
+            self.order = []
+
+    def rollback(self):
+        """
+        Abort: remove every staged file, leaving all targets untouched
+        """
+        for path in list(self.order):
+            self.discard(path)
+
+
+class PlanRecorder(Transaction):
+    """
+    Transaction that keeps staged content in memory instead of writing it,
+    used to compile a plan (see compile_plan)
+    """
+    def open(self, path, mode=None, binary=False):
+        path = os.path.abspath(path)
+        if path in self.staged:
+            self.discard(path)
+        f = StringIO()
+        self.staged[path] = (None, f)
+        self.order.append(path)
+        return f
+
+    def discard(self, path):
+        self.staged.pop(path)
+        self.order.remove(path)
+
+    def commit(self):
+        pass
+
+    def content(self, path):
+        """
+        :return: content staged for path
+        """
+        return self.staged[path][1].getvalue()
+
+
+def file_digest(path):
+    """
+    :param path: file path
+    :return: sha256 of the file content, or None when it does not exist
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_atomic(path, content, mode=None):
+    """
+    Replace a single file atomically (see Transaction)
+    :param path: file path
+    :param content: file content
+    :param mode: permission bits (default: keep those of the existing file)
+    """
+    with Transaction() as txn:
+        txn.stage(path, content, mode)
+
+
+def same_content(path, content):
+    """
+    :param path: file path
+    :param content: new content
+    :return: True when the file already holds content, apart from comment
+             lines (ie: the generated header)
+    """
+    if not os.path.isfile(path):
+        return False
+    current = read_file(path)
+    if current == content:
+        return True
+
+    def strip(text):
+        return [i for i in text.splitlines()
+                if not i.lstrip().startswith('#')]
+    return strip(current) == strip(content)
+
+
+def load_fingerprint():
+    """
+    :return: fingerprint of the last apply ({'config', 'files',
+             'pending'}), or None
+    """
+    try:
+        with open(fingerprint_file) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def save_fingerprint(config, files, pending=None):
+    """
+    Record the applied configuration and the sha256 of each managed file
+    :param config: desired configuration (see ServerClone.desired_config)
+    :param files: managed files
+    :param pending: interfaces that did not come back up (the fingerprint
+                    then never matches, so that they are reloaded again)
+    """
+    fingerprint = {'config': config,
+                   'files': dict((f, file_digest(f)) for f in files),
+                   'pending': sorted(pending or [])}
+    write_atomic(fingerprint_file,
+                 json.dumps(fingerprint, sort_keys=True, indent=4,
+                            separators=(',', ': ')) + '\n')
+
+
+def fingerprint_matches(config, files):
+    """
+    :param config: desired configuration
+    :param files: managed files
+    :return: True when config was applied last and no managed file changed
+             since
+    """
+    fingerprint = load_fingerprint()
+    if not fingerprint or fingerprint.get('config') != config or \
+            fingerprint.get('pending'):
+        return False
+    digests = fingerprint.get('files', {})
+    if sorted(digests) != sorted(files):
+        return False
+    return all(file_digest(f) == digests[f] for f in files)
+
+
+def backup_blob(digest):
+    """
+    :param digest: sha256 of the content
+    :return: path of the content in the backup store
+    """
+    return os.path.join(backup_root, 'objects', digest[:2], digest) + \
+        ('.gz' if backup_compress else '')
+
+
+def backup_manifest(run):
+    """
+    :param run: backup run identifier
+    :return: path of the manifest of a backup run (one JSON entry per line)
+    """
+    return os.path.join(backup_root, 'runs', run, 'manifest.jsonl')
+
+
+def backup_file(cfgfile):
+    """
+    Creates Backup of configuration file in the content-addressed store:
+    the content is stored once under its sha256 (optionally gzipped) and an
+    entry mapping the original path to it is appended to the run manifest.
+    Uncompressed blobs are also hardlinked under runs/<run-id>/files/ for
+    browsing.
+    :param cfgfile: configuration file
+    :return: creates backup if not already backed up in this run
+    """
+    with report.phase('backup'):
+        if not os.path.isfile(cfgfile):
+            print("Unable to backup %s. File does not exist." % cfgfile)
+            return
+        backed_up = _backup_runs.setdefault(backup_root, set())
+        path = os.path.abspath(cfgfile)
+        if path in backed_up:
+            return
+        with open(path, 'rb') as f:
+            content = f.read()
+        report.io(cfgfile, read=len(content))
+        digest = hashlib.sha256(content).hexdigest()
+        blob = backup_blob(digest)
+        if not os.path.exists(blob):
+            if backup_compress:
+                import gzip
+                import io
+                buf = io.BytesIO()
+                with gzip.GzipFile(fileobj=buf, mode='wb') as gz:
+                    gz.write(content)
+                write_atomic(blob, buf.getvalue(), 0o600)
+            else:
+                write_atomic(blob, content, 0o600)
+        entry = {'path': path, 'blob': digest, 'compressed': backup_compress,
+                 'mode': os.stat(path).st_mode & 0o7777, 'size': len(content)}
+        if not backup_compress:
+            link = os.path.join(backup_root, 'runs', run_id, 'files',
+                                path.lstrip('/'))
+            if not os.path.isdir(os.path.dirname(link)):
+                os.makedirs(os.path.dirname(link))
+            if not os.path.exists(link):
+                os.link(blob, link)
+        manifest = backup_manifest(run_id)
+        if not os.path.isdir(os.path.dirname(manifest)):
+            os.makedirs(os.path.dirname(manifest))
+        with open(manifest, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+        backed_up.add(path)
+
+
+def load_backup_manifest(run):
+    """
+    :param run: backup run identifier
+    :return: dict = {'original path': manifest entry}
+    """
+    files = dict()
+    with open(backup_manifest(run)) as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                files[entry['path']] = entry
+    return files
+
+
+def list_backups():
+    """
+    Show the backup runs in the store
+    """
+    runs = os.path.join(backup_root, 'runs')
+    for run in sorted(os.listdir(runs)) if os.path.isdir(runs) else []:
+        try:
+            files = load_backup_manifest(run)
+        except (IOError, ValueError):
+            continue
+        print("%s  %d file(s)" % (run, len(files)))
+
+
+def restore(run):
+    """
+    Put every file backed up by a run back in place
+    :param run: backup run identifier (see list_backups)
+    """
+    try:
+        files = load_backup_manifest(run)
+    except IOError:
+        sys.exit("No backup run %s in %s" % (run, backup_root))
+    with report.phase('restore'), Transaction() as txn:
+        for path in sorted(files):
+            entry = files[path]
+            blob = os.path.join(backup_root, 'objects', entry['blob'][:2],
+                                entry['blob'])
+            if entry['compressed']:
+                import gzip
+                with gzip.open(blob + '.gz', 'rb') as f:
+                    content = f.read()
+            else:
+                with open(blob, 'rb') as f:
+                    content = f.read()
+            txn.stage(path, content, entry['mode'])
+            print("restoring %s" % path)
+
+
+def findmac(iface):
+    """
+    Return permanent MAC address for interface
+    """
+    interfaces = get_interfaces()
+    return interfaces[iface]['perm_address']
+
+
+def is_ip(ip):
+    """
+    Silently validate an IP address (the whole value must match)
+    """
+    try:
+        return bool(valip_full.match(ip or ''))
+    except TypeError:
+        return False
+
+
+def ip_to_int(ip):
+    """
+    Parse an IP address into integer form
+    :return: integer, or None when the address is invalid
+    """
+    if not is_ip(ip):
+        return None
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def int_to_ip(value):
+    """
+    Format an integer as an IP address
+    """
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def netmask_prefix(netmask):
+    """
+    Prefix length of a netmask in integer form
+    :return: prefix length, or None when the netmask is not contiguous
+    """
+    hostmask = ~netmask & 0xffffffff
+    if hostmask & (hostmask + 1):
+        return None
+    return 32 - bin(hostmask).count('1')
+
+
+def validate_plan(plan, allocate=False):
+    """
+    Validate the hostnames and addressing of a plan (one or many hosts) in a
+    single pass, reporting every violation. Each address is parsed once into
+    integer form; duplicate IPs and hostnames are found with sorted indexes,
+    and overlapping subnets on a host with an interval index.
+    :param plan: list of manifests (see build_manifest)
+    :param allocate: accept 'auto' (or missing) IP addresses of interfaces
+                     with a pool, still to be allocated (see
+                     allocate_manifest); they are checked once allocated
+    :return: list of errors (empty when valid)
+    """
+    errors = []
+    addresses = []  # (ip, owner)
+    hostnames = []  # (hostname, owner)
+    gateways = []  # (gateway, owner)
+    for n, manifest in enumerate(plan):
+        if not isinstance(manifest, dict):
+            errors.append("#%d: configuration must be an object" % (n + 1))
+            continue
+        hostname = manifest.get('hostname')
+        host = hostname or '#%d' % (n + 1)
+        if not hostname:
+            errors.append("%s: hostname not specified" % host)
+        elif not valhost.match('%s' % hostname):
+            errors.append("%s: invalid hostname '%s'" % (host, hostname))
+        else:
+            hostnames.append((('%s' % hostname).lower(), host))
+        interfaces = manifest.get('interfaces')
+        if not interfaces or not isinstance(interfaces, dict):
+            errors.append("%s: no interfaces specified" % host)
+            continue
+        subnets = []  # (network, broadcast, interface)
+        for iface in sorted(interfaces):
+            owner = '%s: %s' % (host, iface)
+            conf = interfaces[iface]
+            if not isinstance(conf, dict):
+                errors.append("%s: configuration must be an object" % owner)
+                continue
+            if allocate and conf.get('ip') in (None, '', 'auto'):
+                if iface not in ip_pools:
+                    errors.append("%s: no address pool for an 'auto' IP "
+                                  "address" % owner)
+                for key, name in (('nm', 'netmask'), ('gw', 'gateway')):
+                    if conf.get(key) and ip_to_int(conf[key]) is None:
+                        errors.append("%s: invalid %s '%s'"
+                                      % (owner, name, conf[key]))
+                continue
+            ip, nm, gw = [ip_to_int(conf.get(k)) for k in ('ip', 'nm', 'gw')]
+            for value, key, name in ((ip, 'ip', 'IP address'),
+                                     (nm, 'nm', 'netmask'),
+                                     (gw, 'gw', 'gateway')):
+                if value is None:
+                    errors.append("%s: invalid %s '%s'"
+                                  % (owner, name, conf.get(key)))
+            if ip is not None:
+                addresses.append((ip, owner))
+            if gw is not None:
+                gateways.append((gw, owner))
+            if nm is None:
+                continue
+            prefix = netmask_prefix(nm)
+            if prefix is None:
+                errors.append("%s: invalid netmask '%s' (not contiguous)"
+                              % (owner, conf['nm']))
+                continue
+            if not prefix:
+                errors.append("%s: invalid netmask '%s' (no network bits)"
+                              % (owner, conf['nm']))
+                continue
+            if ip is None:
+                continue
+            network = ip & nm
+            broadcast = network | (~nm & 0xffffffff)
+            cidr = '%s/%d' % (int_to_ip(network), prefix)
+            subnets.append((network, broadcast, iface))
+            if prefix < 31 and ip in (network, broadcast):
+                errors.append("%s: %s is the network or broadcast address "
+                              "of %s" % (owner, conf['ip'], cidr))
+            if gw is None:
+                continue
+            if not network <= gw <= broadcast:
+                errors.append("%s: gateway %s is outside %s"
+                              % (owner, conf['gw'], cidr))
+            elif gw == ip:
+                errors.append("%s: gateway %s is the interface address"
+                              % (owner, conf['gw']))
+            elif prefix < 31 and gw in (network, broadcast):
+                errors.append("%s: gateway %s is the network or broadcast "
+                              "address of %s" % (owner, conf['gw'], cidr))
+        subnets.sort()
+        end, last = -1, None
+        for network, broadcast, iface in subnets:
+            if network <= end:
+                errors.append("%s: subnets of %s and %s overlap"
+                              % (host, last, iface))
+            if broadcast > end:
+                end, last = broadcast, iface
+    for index, name in ((addresses, 'IP address'), (hostnames, 'hostname')):
+        index.sort()
+        start = 0
+        for i in range(1, len(index) + 1):
+            if i == len(index) or index[i][0] != index[start][0]:
+                if i - start > 1:
+                    value = index[start][0]
+                    errors.append("%s %s is assigned more than once: %s"
+                                  % (name, int_to_ip(value)
+                                     if name == 'IP address' else value,
+                                     ', '.join(o for v, o in
+                                               index[start:i])))
+                start = i
+    assigned = dict(addresses)
+    for gw, owner in gateways:
+        if gw in assigned:
+            errors.append("%s: gateway %s is assigned to %s"
+                          % (owner, int_to_ip(gw), assigned[gw]))
+    return errors
+
+
+def parse_range(value):
+    """
+    Parse an address range of a pool
+    :param value: '<network>/<prefix>', '<first>-<last>' or a single address
+    :return: (first, last) addresses in integer form
+    """
+    value = value.strip()
+    if '/' in value:
+        network, prefix = value.split('/', 1)
+        start, prefix = ip_to_int(network), int(prefix)
+        if start is None or not 0 <= prefix <= 32:
+            raise ValueError("Invalid network '%s'" % value)
+        mask = (0xffffffff << (32 - prefix)) & 0xffffffff
+        return start & mask, (start & mask) | (~mask & 0xffffffff)
+    first, sep, last = value.partition('-')
+    first, last = ip_to_int(first.strip()), ip_to_int((last or first).strip())
+    if first is None or last is None or last < first:
+        raise ValueError("Invalid address range '%s'" % value)
+    return first, last
+
+
+def pool_addresses(pool):
+    """
+    Host addresses of a pool, in order, skipping its exclusions
+    :param pool: {'network': '192.168.1.0/24', 'exclude': [ranges]}
+    :return: generator of addresses in integer form
+    """
+    network, broadcast = parse_range(pool['network'])
+    excluded = sorted(parse_range(r) for r in pool.get('exclude') or [])
+    address = network + 1 if broadcast - network > 1 else network
+    last = broadcast - 1 if broadcast - network > 1 else broadcast
+    for first, end in excluded + [(last + 1, last + 1)]:
+        while address < min(first, last + 1):
+            yield address
+            address += 1
+        address = max(address, end + 1)
+
+
+def pool_netmask(pool):
+    """
+    :param pool: see pool_addresses
+    :return: netmask of the pool network
+    """
+    network, broadcast = parse_range(pool['network'])
+    return int_to_ip(~(broadcast - network) & 0xffffffff)
+
+
+def load_ip_index():
+    """
+    :return: addresses assigned so far, dict = {'ip': {'hostname': ..,
+             'assigned': ..}}
+    """
+    try:
+        with open(ip_index) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return dict()
+
+
+@contextmanager
+def ip_index_lock():
+    """
+    Hold an exclusive lock (flock on ip_index.lock) while the address index
+    is read, checked and updated, so that concurrent clones and fleet
+    workers sharing it never hand out the same address
+    """
+    directory = os.path.dirname(os.path.abspath(ip_index))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(ip_index + '.lock', 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+def record_addresses(hostname, addresses):
+    """
+    Record the addresses of a host's interfaces in the persistent index
+    :param hostname: host name
+    :param addresses: dict = {'interface': 'ip'}; any other address the
+                      index held for these interfaces of the host is released
+    """
+    with ip_index_lock():
+        store_addresses(load_ip_index(), hostname, addresses)
+
+
+def store_addresses(index, hostname, addresses):
+    """
+    Write the address index with the addresses of a host's interfaces (the
+    caller holds ip_index_lock)
+    :param index: see load_ip_index
+    :param hostname: host name
+    :param addresses: see record_addresses
+    """
+    index = dict((ip, entry) for ip, entry in index.items()
+                 if (entry['hostname'], entry['interface']) not in
+                 [(hostname, i) for i in addresses])
+    for iface, ip in addresses.items():
+        index[ip] = {'hostname': hostname, 'interface': iface,
+                     'assigned': datetime.datetime.now().isoformat()}
+    write_atomic(ip_index, json.dumps(index, sort_keys=True, indent=4,
+                                      separators=(',', ': ')) + '\n')
+
+
+def icmp_checksum(data):
+    """
+    Internet checksum of an ICMP message
+    """
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!%dH' % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def read_arp_table():
+    """
+    Read the kernel neighbour table in-process
+    :return: addresses with a complete hardware address
+    """
+    found = set()
+    try:
+        with open(procnetarp) as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 4 and int(fields[2], 16) & 0x2 and \
+                        fields[3] != '00:00:00:00:00:00':
+                    found.add(fields[0])
+    except (IOError, ValueError):
+        pass
+    return found
+
+
+def ping_sweep(addresses, timeout=None):
+    """
+    Find addresses in use: one ICMP echo request is sent to every address
+    from a single raw socket and replies are collected until the timeout.
+    Hosts on the local network that drop ICMP still answer the ARP request
+    the kernel sends for them, so the neighbour table is read afterwards.
+    :param addresses: IP addresses
+    :param timeout: seconds to wait for replies (default: sweep_timeout)
+    :return: set of addresses in use
+    :raises socket.error: when a request could not be sent (ie: no route
+                          before the network is up); the addresses are
+                          neither free nor in use
+    """
+    if timeout is None:
+        timeout = sweep_timeout
+    wanted = set(addresses)
+    alive = set()
+    unsent = []
+    ident = os.getpid() & 0xffff
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                         socket.getprotobyname('icmp'))
+    try:
+        for seq, address in enumerate(addresses):
+            header = struct.pack('!BBHHH', 8, 0, 0, ident, seq & 0xffff)
+            payload = b'vmclone'
+            packet = struct.pack('!BBHHH', 8, 0,
+                                 icmp_checksum(header + payload), ident,
+                                 seq & 0xffff) + payload
+            try:
+                sock.sendto(packet, (address, 0))
+            except socket.error as e:
+                unsent.append((address, e))
+        if unsent:
+            raise socket.error("%d address(es) could not be probed (%s: %s)"
+                               % (len(unsent), unsent[0][0], unsent[0][1]))
+        deadline = time() + timeout
+        while time() < deadline:
+            sock.settimeout(deadline - time())
+            try:
+                data, peer = sock.recvfrom(1024)
+            except socket.timeout:
+                break
+            offset = (struct.unpack('!B', data[:1])[0] & 0xf) * 4
+            if len(data) < offset + 8:
+                continue
+            kind, code, checksum, rid = \
+                struct.unpack('!BBHH', data[offset:offset + 6])
+            if kind == 0 and rid == ident and peer[0] in wanted:
+                alive.add(peer[0])
+    finally:
+        sock.close()
+    return alive | (read_arp_table() & wanted)
+
+
+def allocate_address(interface, hostname, prober=None, reserve=True):
+    """
+    Pick the next free address of the pool configured for an interface
+    (ip_pools in settings). An address the index already holds for this
+    interface of the host is reused; addresses held for others are skipped
+    and the remaining candidates are checked in batches of sweep_batch with
+    a concurrent sweep. The address chosen is reserved in the index; the
+    index stays locked from the lookup to the reservation (see
+    ip_index_lock).
+    :param interface: interface name (ie: eth0)
+    :param hostname: host the address is for
+    :param prober: function(addresses) returning those in use (default:
+                   ping_sweep); a socket.error means they could not be
+                   checked and nothing is allocated
+    :param reserve: record the address in the index (False: only suggest
+                    it, the address applied is recorded by apply_settings)
+    :return: (ip, netmask), or None when the interface has no pool, the
+             pool is exhausted or its addresses could not be checked
+    """
+    pool = ip_pools.get(interface)
+    if not pool:
+        return None
+    with ip_index_lock():
+        return find_free_address(pool, interface, hostname, prober, reserve)
+
+
+def find_free_address(pool, interface, hostname, prober, reserve):
+    """
+    See allocate_address (the caller holds ip_index_lock)
+    :param pool: see pool_addresses
+    """
+    index = load_ip_index()
+    for ip, entry in index.items():
+        if entry['hostname'] == hostname and entry['interface'] == interface:
+            return ip, pool_netmask(pool)
+    prober = prober or ping_sweep
+    candidates = (int_to_ip(a) for a in pool_addresses(pool)
+                  if int_to_ip(a) not in index)
+    with report.phase('allocate_address'):
+        while True:
+            batch = []
+            for ip in candidates:
+                batch.append(ip)
+                if len(batch) >= sweep_batch:
+                    break
+            if not batch:
+                print("No free address left in %s" % pool['network'])
+                return None
+            print("Checking %d address(es) of %s for %s.."
+                  % (len(batch), pool['network'], interface))
+            try:
+                in_use = prober(batch)
+            except socket.error as e:
+                print("Unable to check addresses for use: %s" % e)
+                return None
+            free = [ip for ip in batch if ip not in in_use]
+            if free:
+                if reserve:
+                    store_addresses(index, hostname, {interface: free[0]})
+                return free[0], pool_netmask(pool)
+
+
+def allocate_manifest(manifest, prober=None):
+    """
+    Allocate an address (see allocate_address) for every interface of a
+    target configuration whose IP is 'auto' or missing; a missing netmask or
+    gateway is derived from the pool
+    :param manifest: see build_manifest (updated in place)
+    :param prober: see allocate_address
+    """
+    if not ip_pools or not manifest.get('hostname'):
+        return
+    for iface in sorted(manifest.get('interfaces') or {}):
+        conf = manifest['interfaces'][iface]
+        if not isinstance(conf, dict) or conf.get('ip') not in \
+                (None, '', 'auto'):
+            continue
+        allocated = allocate_address(iface, manifest['hostname'], prober)
+        if allocated:
+            conf['ip'] = allocated[0]
+            conf['nm'] = conf.get('nm') or allocated[1]
+            conf['gw'] = conf.get('gw') or default_gateway(conf['ip'],
+                                                           conf['nm'])
+
+
+def valid_ip(ip):
+    """
+    Validate IP Addresses
+    """
+    valid = re.match(valip, ip)
+    if valid:
+        return True
+    else:
+        print("Invalid IP address...")
+
+
+def rewrite(cfgfile, substitutions, txn=None):
+    """
+    Applies a set of substitutions to a file in one read, one pass and one
+    write. A substitution whose pattern is not matched is appended to the
+    file (same semantics as replace).
+    :param cfgfile: configuration file
+    :param substitutions: list of (compiled pattern, substitution) tuples
+    :param txn: Transaction to stage the new content in (default: write now)
+    """
+    filecont = read_file(cfgfile)
+    for pattern, subst in substitutions:
+        filecont, count = pattern.subn(subst, filecont)
+        if not count:
+            filecont += '\n' + subst
+    if txn:
+        txn.stage(cfgfile, filecont)
+    else:
+        write_file(cfgfile, filecont)
+
+
+def replace(cfgfile, pattern, subst):
+    """
+    Matches a pattern in a file and replaces with provided substitution.
+    """
+    rewrite(cfgfile, [(re.compile(pattern), subst)])
+
+
+def parse_hosts_line(line):
+    """
+    Parse an /etc/hosts entry (fields separated by any tabs/spaces)
+    :param line: hosts file line
+    :return: (ip, [hostname, aliases..], comment) or None for lines without
+             an entry
+    """
+    entry, sep, comment = line.rstrip('\n').partition('#')
+    fields = entry.split()
+    if len(fields) < 2:
+        return None
+    return fields[0], fields[1:], sep + comment
+
+
+def rewrite_hosts(path, old_names, records, txn=None):
+    """
+    Rewrite /etc/hosts in one streaming pass to a staged file which then
+    replaces the original. Names of the old host are removed from every entry
+    (entries left without a name are dropped) and the new records are written
+    where the first such entry was, or appended when there was none. Entries
+    are indexed by IP and hostnames as they stream past so that no entry is
+    ever written twice.
+    :param path: hosts file
+    :param old_names: hostnames being replaced (ie: short name and FQDN)
+    :param records: list of (ip, [hostname, aliases..]) to write
+    :param txn: Transaction to stage the new content in (default: commit
+                the new file on its own)
+    """
+    if txn is None:
+        with Transaction() as txn:
+            return rewrite_hosts(path, old_names, records, txn)
+    old_names = set(n for n in old_names if n)
+    records = [(ip, tuple(names)) for ip, names in records]
+    # Only lines mentioning an old name or a record IP need to be parsed
+    relevant = re.compile('|'.join(re.escape(t) for t in
+                                   sorted(old_names) +
+                                   [ip for ip, names in records]))
+    index = set()
+    state = {'read': 0, 'written': 0, 'last': '\n', 'emitted': False}
+
+    def emit(out, text):
+        out.write(text)
+        state['written'] += len(text)
+        state['last'] = text[-1:]
+
+    def emit_records(out):
+        for ip, names in records:
+            if (ip, names) not in index:
+                if state['last'] != '\n':
+                    emit(out, '\n')
+                emit(out, '%s\t\t%s\n' % (ip, ' '.join(names)))
+                index.add((ip, names))
+        state['emitted'] = True
+
+    out = txn.open(path)
+    with open(path, 'r') as filein:
+        for line in filein:
+            state['read'] += len(line)
+            if not relevant.search(line):
+                emit(out, line)
+                continue
+            entry = parse_hosts_line(line)
+            if entry is None:
+                emit(out, line)
+                continue
+            ip, names, comment = entry
+            kept = [n for n in names if n not in old_names]
+            if len(kept) != len(names) and not state['emitted']:
+                emit_records(out)
+            if not kept or (ip, tuple(kept)) in index:
+                continue
+            if len(kept) != len(names):
+                line = '%s\t\t%s%s\n' % (ip, ' '.join(kept),
+                                         comment and ' ' + comment)
+            index.add((ip, tuple(kept)))
+            emit(out, line)
+    if not state['emitted']:
+        emit_records(out)
+    report.io(path, read=state['read'], written=state['written'])
+
+
+def render_interface(iface, ip, nm, gw, uuid, mac=None):
+    """
+    Render the content of an ifcfg-<interface> file
+    :param iface: interface name (ie: eth0)
+    :param ip: IP address
+    :param nm: netmask
+    :param gw: gateway
+    :param uuid: connection UUID
+    :param mac: MAC address (default: permanent address of the interface)
+    :return: file content
+    """
+    return ('# This file was generated by vmclone.py on %s\n'
+            'DEVICE=%s\n'
+            'HWADDR=%s\n'
+            'IPADDR=%s\n'
+            'NETMASK=%s\n'
+            'GATEWAY=%s\n'
+            'BOOTPROTO=none\n'
+            'ONBOOT=yes\n'
+            'UUID=%s\n'
+            'NM_CONTROLLED=no\n' % (datetime.datetime.now(), iface,
+                                    mac or findmac(iface), ip, nm, gw,
+                                    uuid))
+
+
+def ifcfg_settings(content):
+    """
+    Settings of an ifcfg-<interface> file, ignoring comments, quoting and
+    the connection UUID (which the network scripts do not use)
+    :param content: file content
+    :return: dict = {'KEY': 'value'}
+    """
+    settings = dict()
+    for line in content.splitlines():
+        key, sep, value = line.strip().partition('=')
+        if sep and not key.startswith('#') and key != 'UUID':
+            settings[key.strip()] = value.strip().strip('"\'')
+    return settings
+
+
+def interface_settings(interfaces):
+    """
+    :param interfaces: interface names
+    :return: dict = {'interface': ifcfg settings (see ifcfg_settings), or
+             None without an ifcfg file}
+    """
+    current = dict()
+    for iface in interfaces:
+        cfg_file = ifcfg_path + '/ifcfg-%s' % iface
+        if os.path.isfile(cfg_file):
+            current[iface] = ifcfg_settings(read_file(cfg_file))
+        else:
+            current[iface] = None
+    return current
+
+
+def changed_interfaces(before):
+    """
+    :param before: interface settings taken before writing (see
+                   interface_settings)
+    :return: interfaces whose ifcfg settings have changed since
+    """
+    after = interface_settings(before)
+    return sorted(i for i in before if before[i] != after[i])
+
+
+rule_address = re.compile(r'ATTR\{address\}=="([^"]*)".*NAME="([^"]*)"')
+
+
+def render_persistent_rules(table, content=''):
+    """
+    Render 70-persistent-net.rules (udev interface naming, CentOS 6) for an
+    interface table, in the format written by udev's write_net_rules. Rules
+    of the current content for other devices are kept; rules binding one of
+    the table's MAC addresses or names are replaced.
+    :param table: dict = {'interface': 'MAC address'}
+    :param content: current rules file content
+    :return: file content
+    """
+    blocks = []
+    for iface in sorted(table):
+        description = None if root_prefix else read_device_description(iface)
+        blocks.append('%sSUBSYSTEM=="net", ACTION=="add", DRIVERS=="?*", '
+                      'ATTR{address}=="%s", ATTR{type}=="1", KERNEL=="eth*", '
+                      'NAME="%s"\n'
+                      % ('# %s\n' % description if description else '',
+                         table[iface].lower(), iface))
+    addresses = set(mac.lower() for mac in table.values())
+    for block in content.split('\n\n'):
+        rule = rule_address.search(block)
+        if rule and rule.group(1).lower() not in addresses and \
+                rule.group(2) not in table:
+            blocks.append(block.strip('\n') + '\n')
+    return ('# This file was generated by vmclone.py on %s\n'
+            '#\n'
+            '# You can modify it, as long as you keep each rule on a single\n'
+            '# line, and change only the value of the NAME= key.\n'
+            % datetime.datetime.now()) + ''.join('\n' + b for b in blocks)
+
+
+def gen_interface(cfgfile, iface, ip, nm, gw, txn=None, mac=None):
+    """
+    Re-Generate ifcfg-eth<x> file with the new network information
+    :param cfgfile: full path to interface configuration
+    :param iface: interface name (ie: eth0)
+    :param ip: IP address
+    :param nm: netmask
+    :param gw: gateway
+    :param txn: Transaction to stage the new content in (default: write now)
+    :param mac: MAC address (default: permanent address of the interface)
+    :return:
+    """
+    mac = mac or findmac(iface)
+    newuuid = None
+    if os.path.isfile(cfgfile) and \
+            (current_mac(cfgfile) or '').strip('"\'').lower() == mac.lower():
+        # Same NIC as before: keep its connection UUID
+        newuuid = current_uuid(cfgfile)
+    if not newuuid:
+        newuuid = run_command(['uuidgen'], stdout=subprocess.PIPE,
+                              universal_newlines=True)[1].strip()
+    print("Generating interface %s.." % iface)
+    content = render_interface(iface, ip, nm, gw, newuuid, mac)
+    if txn:
+        txn.stage(cfgfile, content)
+    else:
+        write_file(cfgfile, content)
+
+
+class ConfDocument:
+    """
+    Lossless model of a directive-per-line configuration file (resolv.conf,
+    ntp.conf): every line is kept verbatim, in order, and only the directive
+    lines being edited are replaced, so comments, blank lines and other
+    directives round-trip unchanged.
+    """
+    def __init__(self, content):
+        self.lines = content.splitlines(True)
+
+    @staticmethod
+    def directive(line):
+        """
+        :param line: configuration line
+        :return: fields of a directive line, or None for blank lines and
+                 comments ('#' or ';')
+        """
+        fields = line.split()
+        if not fields or fields[0].startswith(('#', ';')):
+            return None
+        return fields
+
+    def values(self, name):
+        """
+        :param name: directive name (ie: nameserver)
+        :return: first argument of each directive with that name, in order
+        """
+        return [fields[1] for fields in map(self.directive, self.lines)
+                if fields and fields[0] == name and len(fields) > 1]
+
+    def set(self, name, values, keep=None):
+        """
+        Replace the directives with a name by one per value, in order, where
+        the first of them was (appended when there was none). A directive
+        already present for a value is kept as it is (ie: with its options).
+        :param name: directive name (ie: server)
+        :param values: first argument of each new directive
+        :param keep: function(fields) selecting directives to leave alone
+        """
+        existing = dict()
+        positions = []
+        for i, line in enumerate(self.lines):
+            fields = self.directive(line)
+            if fields and fields[0] == name and not (keep and keep(fields)):
+                positions.append(i)
+                if len(fields) > 1:
+                    existing.setdefault(fields[1], line)
+        new = []
+        for value in values:
+            line = existing.get(value) or '%s %s\n' % (name, value)
+            new.append(line if line.endswith('\n') else line + '\n')
+        at = positions[0] if positions else len(self.lines)
+        lines = [line for i, line in enumerate(self.lines)
+                 if i not in positions[1:]]
+        if positions:
+            del lines[at]
+        elif lines and not lines[-1].endswith('\n'):
+            lines[-1] += '\n'
+        self.lines = lines[:at] + new + lines[at:]
+
+    def text(self):
+        """
+        :return: file content
+        """
+        return ''.join(self.lines)
+
+
+def render_resolvconf(content, servers):
+    """
+    Replace the nameserver entries of resolv.conf
+    :param content: current resolv.conf content
+    :param servers: nameservers to write (in order)
+    :return: new content
+    """
+    document = ConfDocument(content)
+    document.set('nameserver', servers)
+    return document.text()
+
+
+def render_ntpconf(content, servers):
+    """
+    Replace the server entries of ntp.conf (the local clock driver,
+    127.127.x.x, is kept along with its fudge line)
+    :param content: current ntp.conf content
+    :param servers: NTP servers to write (in order)
+    :return: new content
+    """
+    document = ConfDocument(content)
+    document.set('server', servers,
+                 keep=lambda fields: fields[1:2] and
+                 fields[1].startswith('127.127.'))
+    return document.text()
+
+
+def update_conf(path, render, servers, txn=None):
+    """
+    Update resolv.conf/ntp.conf with one read and, only when the content
+    changes, one atomic write
+    :param path: configuration file
+    :param render: render_resolvconf or render_ntpconf
+    :param servers: servers to write (in order)
+    :param txn: Transaction to stage the new content in (default: write now)
+    :return: True when the file was written (or staged)
+    """
+    content = read_file(path)
+    new = render(content, servers)
+    if new == content:
+        return False
+    if txn:
+        txn.stage(path, new)
+    else:
+        write_atomic(path, new)
+    return True
+
+
+def dns_probe(address, timeout):
+    """
+    Send one DNS query over UDP (root NS, recursion desired) and wait for a
+    matching answer
+    :param address: nameserver IP address
+    :param timeout: seconds to wait for the answer
+    :return: {'rtt': seconds}, or None without a usable answer
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        qid = struct.unpack('!H', os.urandom(2))[0]
+        query = struct.pack('!HHHHHH', qid, 0x0100, 1, 0, 0, 0) + \
+            b'\0' + struct.pack('!HH', 2, 1)
+        started = time()
+        deadline = started + timeout
+        sock.sendto(query, (address, dns_port))
+        while time() < deadline:
+            sock.settimeout(deadline - time())
+            data = sock.recv(512)
+            if len(data) < 12:
+                continue
+            rid, flags = struct.unpack('!HH', data[:4])
+            if rid == qid and flags & 0x8000:
+                if flags & 0xf not in (0, 3):  # NOERROR, NXDOMAIN
+                    return None
+                return {'rtt': time() - started}
+    except (socket.error, ValueError):
+        pass
+    finally:
+        sock.close()
+    return None
+
+
+def ntp_timestamp(seconds):
+    """
+    :param seconds: unix time
+    :return: 64 bit NTP timestamp (bytes)
+    """
+    seconds += NTP_EPOCH
+    return struct.pack('!II', int(seconds),
+                       int((seconds - int(seconds)) * 2 ** 32))
+
+
+def ntp_time(timestamp):
+    """
+    :param timestamp: 64 bit NTP timestamp (bytes)
+    :return: unix time
+    """
+    seconds, fraction = struct.unpack('!II', timestamp)
+    return seconds - NTP_EPOCH + fraction / 2.0 ** 32
+
+
+def sntp_probe(address, timeout):
+    """
+    Send one SNTP (v3, client mode) request over UDP and wait for a matching
+    answer from a synchronized server
+    :param address: NTP server IP address
+    :param timeout: seconds to wait for the answer
+    :return: {'rtt': seconds, 'stratum': .., 'offset': seconds}, or None
+             without a usable answer
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        started = time()
+        deadline = started + timeout
+        transmit = ntp_timestamp(started)
+        sock.sendto(b'\x1b' + b'\0' * 39 + transmit, (address, ntp_port))
+        while time() < deadline:
+            sock.settimeout(deadline - time())
+            data = sock.recv(512)
+            received = time()
+            if len(data) < 48 or data[24:32] != transmit:
+                continue
+            flags, stratum = struct.unpack('!BB', data[:2])
+            if flags & 0x7 != 4 or flags >> 6 == 3 or not 0 < stratum < 16:
+                return None  # not a server answer, unsynchronized or KoD
+            t2, t3 = ntp_time(data[32:40]), ntp_time(data[40:48])
+            return {'rtt': (received - started) - (t3 - t2),
+                    'stratum': stratum,
+                    'offset': ((t2 - started) + (t3 - received)) / 2}
+    except (socket.error, ValueError):
+        pass
+    finally:
+        sock.close()
+    return None
+
+
+def probe_server(probe, server, timeout):
+    """
+    Measure a server with up to probe_samples probes within timeout
+    :param probe: probe function (see dns_probe, sntp_probe)
+    :param server: IP address or hostname
+    :param timeout: seconds allowed for all samples
+    :return: the sample with the lowest round trip time (plus the number
+             of 'samples' answered), or None when the server never answered
+    """
+    deadline = time() + timeout
+    try:
+        address = socket.gethostbyname(server)
+    except (socket.error, UnicodeError):
+        return None
+    samples = []
+    for i in range(probe_samples):
+        remaining = deadline - time()
+        if remaining <= 0:
+            break
+        sample = probe(address, remaining)
+        if sample:
+            samples.append(sample)
+    if not samples:
+        return None
+    best = dict(min(samples, key=lambda s: s['rtt']))
+    best['samples'] = len(samples)
+    return best
+
+
+def run_probes(kind, probe, servers, timeout=None):
+    """
+    Probe servers concurrently in-process (probe_workers threads). A server
+    that does not answer (or resolve) in time counts as unreachable and
+    cannot stall the run.
+    :param kind: probe type ('dns', 'ntp')
+    :param probe: probe function (see dns_probe, sntp_probe)
+    :param servers: IP addresses or hostnames
+    :param timeout: seconds allowed for each server (default: probe_timeout)
+    :return: list of (server, result or None), in the order given
+    """
+    if timeout is None:
+        timeout = probe_timeout
+    queue = list(servers)
+    results = dict()
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if not queue:
+                    return
+                server = queue.pop(0)
+            started = time()
+            results[server] = probe_server(probe, server, timeout)
+            report.probe(kind, server, time() - started, results[server])
+
+    workers = max(min(probe_workers, len(servers)), 1)
+    threads = [threading.Thread(target=worker) for i in range(workers)]
+    deadline = time() + timeout * -(-len(servers) // workers) + 1
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(max(deadline - time(), 0))
+    return [(server, results.get(server)) for server in servers]
+
+
+def read_routes():
+    """
+    Read the IPv4 routing table in-process
+    :return: list of (interface, destination, gateway, mask), addresses in
+             integer form
+    """
+    routes = []
+    try:
+        with open(procnetroute) as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                if len(fields) < 8:
+                    continue
+                dest, gw, mask = [
+                    struct.unpack('!I', struct.pack('=I', int(x, 16)))[0]
+                    for x in (fields[1], fields[2], fields[7])]
+                routes.append((fields[0], dest, gw, mask))
+    except (IOError, ValueError):
+        pass
+    return routes
+
+
+def probe_network(server, routes):
+    """
+    Source network of the probes to a server: the directly connected network
+    of the interface routing to it (longest prefix match; hostnames use the
+    default route). Clones on the same network share probe results.
+    :param server: IP address or hostname
+    :param routes: see read_routes
+    :return: 'network/prefix' (or the interface name when it has no
+             connected route), None when there is no route
+    """
+    address = ip_to_int(server)
+    if address is None:
+        matches = [r for r in routes if not r[3]]
+    else:
+        matches = [r for r in routes if address & r[3] == r[1]]
+    if not matches:
+        return None
+    iface = max(matches, key=lambda r: r[3])[0]
+    connected = sorted([r for r in routes
+                        if r[0] == iface and r[3] and not r[2]],
+                       key=lambda r: r[3], reverse=True)
+    if not connected:
+        return iface
+    for r in connected:
+        if address is not None and address & r[3] == r[1]:
+            break
+    else:
+        r = connected[0]
+    return '%s/%d' % (int_to_ip(r[1]), netmask_prefix(r[3]))
+
+
+def probe_cache_files():
+    """
+    :return: local probe cache file followed by those of the shared
+             directory (one per network)
+    """
+    files = [probe_cache]
+    if probe_cache_shared and os.path.isdir(probe_cache_shared):
+        files.extend(sorted(glob.glob(os.path.join(probe_cache_shared,
+                                                   '*.json'))))
+    return files
+
+
+def load_probe_cache():
+    """
+    Load probe results from the local cache and the shared directory; the
+    most recent result for a server and network wins
+    :return: dict = {'<kind> <server> <network>':
+                     {'result': .., 'checked': ..}} (entries written by
+             earlier versions hold 'ok' instead of 'result')
+    """
+    cache = dict()
+    for path in probe_cache_files():
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            continue
+        for key, entry in entries.items():
+            if not isinstance(entry, dict) or 'checked' not in entry:
+                continue
+            if key not in cache or entry['checked'] > cache[key]['checked']:
+                cache[key] = entry
+    return cache
+
+
+def save_probe_cache(results):
+    """
+    Merge new probe results into the local cache and the shared directory.
+    Each file is replaced atomically; a result lost to a concurrent writer
+    is only probed again.
+    :param results: dict = {(kind, server, network):
+                            {'result': .., 'checked': ..}}
+    """
+    targets = {probe_cache: results}
+    if probe_cache_shared:
+        for key, entry in results.items():
+            name = (key[2] or 'unrouted').replace('/', '_') + '.json'
+            path = os.path.join(probe_cache_shared, name)
+            targets.setdefault(path, dict())[key] = entry
+    for path, entries in targets.items():
+        try:
+            with open(path) as f:
+                cache = json.load(f)
+        except (IOError, ValueError):
+            cache = dict()
+        now = time()
+        cache = dict((k, v) for k, v in cache.items()
+                     if isinstance(v, dict) and 'result' in v and
+                     now - v.get('checked', 0) < probe_cache_ttl)
+        for key, entry in entries.items():
+            cache['%s %s %s' % key] = entry
+        try:
+            write_atomic(path, json.dumps(cache, sort_keys=True))
+        except (IOError, OSError) as e:
+            print("Unable to save probe results to %s: %s" % (path, e))
+
+
+def cached_probes(kind, probe, servers, refresh=False):
     """
-    Creates Backup of configuration file
-    :param cfgfile: configuration file
-    :return: creates backup if backup not already exists
+    Run probes through the probe cache: results younger than probe_cache_ttl
+    for the same server and source network are reused and only missing or
+    stale entries are probed (see run_probes)
+    :param kind: probe type ('dns', 'ntp')
+    :param probe: probe function (see dns_probe, sntp_probe)
+    :param servers: IP addresses or hostnames
+    :param refresh: probe every server and update the cache
+    :return: list of (server, result or None), in the order given
     """
-    backup_dir = script_path + '/cfg_backups/%s' % date
-    if not os.path.exists(backup_dir):
-        os.makedirs(backup_dir)
-    p, f = os.path.split(cfgfile)
-    if os.path.isfile("%s%s" % (backup_dir, f)):
-        pass
-    else:
-        if os.path.isfile(cfgfile):
-            shutil.copy(cfgfile, backup_dir)
+    if not probe_cache_ttl:
+        return run_probes(kind, probe, servers)
+    routes = read_routes()
+    keys = dict((server, (kind, server, probe_network(server, routes)))
+                for server in servers)
+    cache = dict() if refresh else load_probe_cache()
+    now = time()
+    results = dict()
+    stale = []
+    for server in servers:
+        entry = cache.get('%s %s %s' % keys[server])
+        # Entries without a result (earlier cache format) count as stale
+        if entry and 'result' in entry and \
+                now - entry['checked'] < probe_cache_ttl:
+            results[server] = entry['result']
         else:
-            print("Unable to backup %s. File does not exist." % cfgfile)
+            stale.append(server)
+    if stale:
+        checked = time()
+        updates = dict()
+        for server, result in run_probes(kind, probe, stale):
+            results[server] = result
+            updates[keys[server]] = {'result': result, 'checked': checked}
+        save_probe_cache(updates)
+    return [(server, results[server]) for server in servers]
 
 
-def findmac(iface):
+def rank_servers(results):
     """
-    Return permanent MAC address for interface
+    Order reachable servers by round trip time (settings order on ties),
+    keeping the probe_keep fastest when set
+    :param results: list of (server, result or None)
+    :return: servers
     """
-    interfaces = get_interfaces()
-    return interfaces[iface]['perm_address']
+    ranked = [server for server, result in
+              sorted([r for r in results if r[1]], key=lambda r: r[1]['rtt'])]
+    return ranked[:probe_keep] if probe_keep else ranked
 
 
-def valid_ip(ip):
+def probe_nameservers(refresh=False):
     """
-    Validate IP Addresses
+    Probe every nameserver outlined in the settings file at once (DNS query
+    over UDP)
+    :param refresh: ignore cached probe results (see cached_probes)
+    :return: list of (nameserver, result or None), settings order
     """
-    valid = re.match(valip, ip)
-    if valid:
-        return True
-    else:
-        print("Invalid IP address...")
+    with report.phase('probe_nameservers'):
+        return cached_probes('dns', dns_probe,
+                             [ns for ns in nameservers if valid_ip(ns)],
+                             refresh)
 
 
-def replace(cfgfile, pattern, subst):
+def probe_ntpservers(refresh=False):
     """
-    Matches a pattern in a file and replaces with provided substitution.
+    Probe every NTP server outlined in the settings file at once (SNTP over
+    UDP)
+    :param refresh: ignore cached probe results (see cached_probes)
+    :return: list of (NTP server, result or None), settings order
     """
-    with open(cfgfile, 'r') as filein:
-        filecont = filein.read()
-    if re.search(pattern, filecont):
-        filecont = (re.sub(pattern, subst, filecont))
-        with open(cfgfile, 'w') as fileout:
-            fileout.write(filecont)
-    else:
-        with open(cfgfile, 'a') as fileout:
-            fileout.write('\n' + subst)
+    with report.phase('probe_ntpservers'):
+        return cached_probes('ntp', sntp_probe, ntpservers, refresh)
 
 
-def gen_interface(cfgfile, iface):
+def reachable_nameservers(refresh=False):
     """
-    Re-Generate ifcfg-eth<x> file with temporary network information
-    :param cfgfile: full path to interface configuration
-    :param iface: interface name (ie: eth0)
-    :return:
+    :param refresh: ignore cached probe results (see cached_probes)
+    :return: Nameservers found as reachable, fastest first
     """
-    newuuid = subprocess.Popen('uuidgen', stdout=subprocess.PIPE)
-    newuuid = newuuid.stdout.readlines()[0].strip()
-    print("Generating interface %s.." % iface)
-    with open(cfgfile, 'w') as f:
-        f.write('# This file was generated by vmclone.py on %s\n'
-                % datetime.datetime.now())
-        f.write('DEVICE=%s\n' % iface)
-        f.write('HWADDR=%s\n' % findmac(iface))
-        f.write('IPADDR=123.123.123.123\n')
-        f.write('NETMASK=255.255.255.0\n')
-        f.write('GATEWAY=123.123.123.123\n')
-        f.write('BOOTPROTO=none\n')
-        f.write('ONBOOT=yes\n')
-        f.write('UUID=%s\n' % newuuid)
-        f.write('NM_CONTROLLED=no\n')
-
-
-def get_nameservers(write=None):
+    return rank_servers(probe_nameservers(refresh))
+
+
+def reachable_ntpservers(refresh=False):
+    """
+    :param refresh: ignore cached probe results (see cached_probes)
+    :return: NTP servers found as reachable, fastest first
+    """
+    return rank_servers(probe_ntpservers(refresh))
+
+
+def get_nameservers(write=None, refresh=False):
     """
     Display responsive nameservers outlined in the settings file
     :param write: Writes nameservers to resolv.conf
-    :return: Nameservers found as reachable
+    :param refresh: probe again instead of using cached results
+    :return: Nameservers found as reachable (fastest first)
     """
     print("\nChecking for available Name Servers..\n"
           "The following servers are reachable:\n")
+    results = probe_nameservers(refresh)
+    reachable = rank_servers(results)
+    results = dict(results)
+    for ns in reachable:
+        print('nameserver %-16s %7.1f ms' % (ns, results[ns]['rtt'] * 1000))
     if write:
-        with open(resolvconf, 'r') as f:
-            lines = f.readlines()
-        with open(resolvconf, 'w') as f:
-            for line in lines:
-                if "nameserver" in line:
-                    pass
-                else:
-                    f.write(line)
-    for ns in nameservers:
-        if valid_ip(ns):
-            r = subprocess.Popen(['nc', '-v', '-z', '%s' % ns, '53'],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT)
-            if r.wait() == 0:
-                print('nameserver %s' % ns)
-                if write:
-                    with open(resolvconf, 'a') as f:
-                        f.write('\nnameserver %s' % ns)
-    if write:
-        print("The above servers have been written to %s" % resolvconf)
+        if update_conf(resolvconf, render_resolvconf, reachable):
+            print("The above servers have been written to %s" % resolvconf)
+        else:
+            print("%s already lists the above servers" % resolvconf)
+    return reachable
 
 
-def get_ntpservers():
+def get_ntpservers(refresh=False):
     """
     Display responsive NTP servers outlined in the settings file
-    :return: NTP servers found as reachable
+    :param refresh: probe again instead of using cached results
+    :return: NTP servers found as reachable (fastest first)
     """
     print("\nChecking for available NTP Servers..\n"
           "The following servers are reachable:\n")
-    for ntp in ntpservers:
-        r = subprocess.Popen(['ntpdate', '-u', '%s' % ntp],
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-        if r.wait() == 0:
-            print('server %s' % ntp)
+    results = probe_ntpservers(refresh)
+    reachable = rank_servers(results)
+    results = dict(results)
+    for ntp in reachable:
+        print('server %-20s %7.1f ms  stratum %-2d offset %+.3fs'
+              % (ntp, results[ntp]['rtt'] * 1000, results[ntp]['stratum'],
+                 results[ntp]['offset']))
+    return reachable
 
 
-def clean_shutdown(option):
+def keygen(job):
+    """
+    Generate one ssh host key pair (runs in a worker of generate_host_keys)
+    :param job: (key type, key comment)
+    :return: (key type, private key, public key)
+    """
+    keytype, comment = job
+    workdir = tempfile.mkdtemp(prefix='vmclone-keygen-')
+    try:
+        key = os.path.join(workdir, 'key')
+        if run_command(['ssh-keygen', '-q', '-t', keytype, '-N', '',
+                        '-C', comment, '-f', key],
+                       stdout=DEVNULL, stderr=DEVNULL)[0] != 0:
+            raise RuntimeError("ssh-keygen failed for %s host key" % keytype)
+        with open(key, 'rb') as f:
+            private = f.read()
+        with open(key + '.pub', 'rb') as f:
+            public = f.read()
+    finally:
+        shutil.rmtree(workdir)
+    return keytype, private, public
+
+
+def generate_host_keys(hostname, types=None):
+    """
+    Generate a fresh ssh host key set, one ssh-keygen process per key type,
+    all at once
+    :param hostname: new hostname (key comment)
+    :param types: key types (default: ssh_host_keys)
+    :return: list of (key type, private key, public key)
+    """
+    from multiprocessing.pool import ThreadPool
+    types = types or ssh_host_keys
+    pool = ThreadPool(len(types))
+    try:
+        with report.phase('ssh_keygen'):
+            return pool.map(keygen, [(t, 'root@%s' % hostname)
+                                     for t in types], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def stage_host_keys(txn, keys):
+    """
+    Stage new ssh host keys in sshdir (private keys 0600, public keys 0644)
+    :param txn: Transaction (committed with the other configuration files)
+    :param keys: see generate_host_keys
+    :return: paths of the staged keys
+    """
+    staged = []
+    for keytype, private, public in keys:
+        path = os.path.join(sshdir, 'ssh_host_%s_key' % keytype)
+        txn.stage(path, private, 0o600)
+        txn.stage(path + '.pub', public, 0o644)
+        staged.extend([path, path + '.pub'])
+    return staged
+
+
+def remove_other_host_keys(installed):
+    """
+    Remove every ssh_host_* file but the new keys, so that no key of the
+    template is left behind
+    :param installed: paths of the new keys (see stage_host_keys)
+    """
+    for sshfile in glob.glob('%s/ssh_host_*' % sshdir):
+        if os.path.isfile(sshfile) and sshfile not in installed:
+            print("deleting %s" % sshfile)
+            os.remove(sshfile)
+    for path in sorted(installed):
+        print("%s generated.." % path)
+
+
+def unidentify(remove_ifcfg=True, remove_rules=True, remove_keys=True):
     """
     Removes udev net rules and ssh host files that are automatically generated
     on boot.
     This ensures that any new servers cloned from this 'template' will
     have unique MAC addresses and ssh host keys.
+    :param remove_ifcfg: also backup and remove the ifcfg-<interface> files
+    :param remove_rules: remove the udev net rules (kept when they were just
+                         generated for the clone's MAC addresses)
+    :param remove_keys: remove the ssh host keys (kept when they were just
+                        generated for the clone, see ssh_host_keys)
     """
-    if int(get_release()) <= 6:
+    with report.phase('unidentify'):
+        _unidentify(remove_ifcfg, remove_rules, remove_keys)
+
+
+def _unidentify(remove_ifcfg, remove_rules, remove_keys):
+    if remove_rules and int(get_release() or 0) <= 6:
         if os.path.isfile(persistent):
             print("deleting %s" % persistent)
             os.remove(persistent)
-    for sshfile in glob.glob('/etc/ssh/ssh_host_*'):
+    for sshfile in glob.glob('%s/ssh_host_*' % sshdir) if remove_keys else []:
         if os.path.isfile(sshfile):
             print("deleting %s" % sshfile)
             os.remove(sshfile)
+    if not remove_ifcfg:
+        return
     for i_cfg in glob.glob('%s/ifcfg-*' % ifcfg_path):
         if re.match(r'^.*ifcfg-lo$', i_cfg):
             continue
         else:
             backup_file(i_cfg)
             os.remove(i_cfg)
-    sleep(2)
+
+
+def clean_shutdown(option):
+    """
+    Un-identify this server (see unidentify) and shut it down.
+    :param option: 'halt' or 'reboot'
+    """
+    unidentify()
     if option == 'halt':
         command = "/sbin/shutdown -h now"
     else:
         command = "/sbin/shutdown -r now"
-    subprocess.Popen(command.split())
+    spawn(command.split())
+
+
+class Prefetch:
+    """
+    Run a function in a background thread while the main thread goes on
+    (ie: prompts the operator); result() waits for its return value.
+    """
+    def __init__(self, func, *args):
+        self.value = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, args=(func,) + args)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, func, *args):
+        try:
+            self.value = func(*args)
+        except Exception as e:
+            self.error = e
+
+    def result(self):
+        """
+        :return: return value of the function (its exception is raised)
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def backup_current(interfaces):
+    """
+    Back up the current version of every file a clone may write
+    :param interfaces: discovered interfaces (see get_interfaces)
+    """
+    files = [ifcfg_path + '/ifcfg-%s' % i for i in sorted(interfaces)]
+    for cfgfile in files + [network, hosts, resolvconf, ntpconf, persistent]:
+        if os.path.isfile(cfgfile):
+            backup_file(cfgfile)
 
 
 class ServerClone:
     """
     Main Configuration Object
     """
-    def __init__(self, mode=0):
+    def __init__(self, mode=0, headless=False):
         self.runmode = mode
+        self.headless = headless
         self.old_serv = current_hostname('HOSTNAME')
         self.new_serv = None
         self.interfaces = dict()
-        self.oldip = 'IPADDR=%s' % valip
-        self.oldnm = 'NETMASK=%s' % valip
-        self.oldgw = 'GATEWAY=%s' % valip
-        self.oldmac = 'HWADDR=%s' % valmac
-        self.proto_dhcp = 'BOOTPROTO=%s' % valproto
-        self.proto_stat = 'BOOTPROTO=none'
         self.ip = None
         self.nm = None
         self.gw = None
         self.new_ip = None
         self.new_nm = None
         self.new_gw = None
-        self.ntppos = None
+        self.nameservers = None
+        self.ntpservers = None
+        self.ready = dict()
+        self.runner = run_command  # network commands (see restart_network)
+        self.jobs = dict()  # background work (see prefetch)
+
+    def prefetch(self):
+        """
+        Start interface discovery, the nameserver and NTP server probes (see
+        write_servers) and the backups in the background, so they run while
+        the operator answers the prompts (see prefetched)
+        """
+        discovery = Prefetch(get_interfaces)
+        self.jobs['interfaces'] = discovery
+        if write_servers and os.path.isfile(resolvconf):
+            self.jobs['nameservers'] = Prefetch(reachable_nameservers)
+        if write_servers and os.path.isfile(ntpconf):
+            self.jobs['ntpservers'] = Prefetch(reachable_ntpservers)
+        self.jobs['backups'] = Prefetch(
+            lambda: backup_current(discovery.result()))
+
+    def prefetched(self, name, func, *args):
+        """
+        :param name: background job (see prefetch)
+        :param func: function computing the result when not prefetched
+        :return: result of the job, waiting for it if still running
+        """
+        if name in self.jobs:
+            return self.jobs[name].result()
+        return func(*args)
 
     def set_hostname(self):
         """
@@ -343,43 +2279,14 @@ class ServerClone:
             sys.exit("Unable to open %s" % ntpconf)
         print("\nChecking for available NTP Servers..\n"
               "The following servers are reachable:\n")
-        with open(ntpconf, 'r') as f:
-            lines = f.readlines()
-            self.ntppos = [i for i, item in enumerate(lines)
-                           if re.search(r'\bserver\b', item)]
-        with open(ntpconf, 'w') as f:
-            for line in lines:
-                if "server" in line:
-                    pass
-                else:
-                    f.write(line)
-        accessible = []
-        for ntp in ntpservers:
-            r = subprocess.Popen(['ntpdate', '-u', '%s' % ntp],
-                                 stdout=subprocess.PIPE,
-                                 stderr=subprocess.STDOUT)
-            if r.wait() == 0:
-                accessible.append(ntp)
-                print('server %s' % ntp)
+        accessible = reachable_ntpservers()
+        for ntp in accessible:
+            print('server %s' % ntp)
         if accessible:
-            if self.ntppos:
-                with open(ntpconf, 'r') as f:
-                    lines = f.readlines()
-                for i, a in enumerate(accessible):
-                    if i == 0:
-                        newline = '\nserver %s\n' % a
-                        lines.insert(self.ntppos[0], newline)
-                    else:
-                        newline = '\nserver %s' % a
-                        lines.insert(self.ntppos[0], newline)
-                with open(ntpconf, 'w') as out:
-                    out.writelines(lines)
+            if update_conf(ntpconf, render_ntpconf, accessible):
+                print("The above servers have been written to %s" % ntpconf)
             else:
-                with open(ntpconf, 'a') as out:
-                    for i, a in enumerate(accessible):
-                        newline = '\nserver %s' % a
-                        out.write(newline)
-            print("The above servers have been written to %s" % ntpconf)
+                print("%s already lists the above servers" % ntpconf)
         else:
             print("Warning:\n"
                   "All servers specified by settings are inaccessible.")
@@ -389,7 +2296,8 @@ class ServerClone:
         Show proposed object configuration
         :return:
         """
-        os.system('clear')
+        if not self.headless:
+            clear_screen()
         print("Proposed Network Configuration:")
         print("Hostname: %s\n" % clone.new_serv)
         for i in sorted(self.interfaces):
@@ -415,45 +2323,191 @@ class ServerClone:
 
     def commit_settings(self):
         """
-        Write configuration files
+        Write configuration files, with the prefetched servers (see prefetch)
         """
         try:
-            for i in sorted(self.interfaces):
-                cfg_file = ifcfg_path + '/ifcfg-%s' % i
-                backup_file(cfg_file)
-                gen_interface(cfg_file, i)
-                replace(cfg_file, self.oldip, 'IPADDR=%s'
-                        % self.interfaces[i]['ip'])
-                replace(cfg_file, self.oldnm, 'NETMASK=%s'
-                        % self.interfaces[i]['nm'])
-                replace(cfg_file, self.oldgw, 'GATEWAY=%s'
-                        % self.interfaces[i]['gw'])
-                replace(cfg_file, self.oldmac, 'HWADDR=%s' % findmac(i))
-                replace(cfg_file, self.proto_dhcp, self.proto_stat)
-                print('Interface %s configured..' % i)
-                sleep(1)
-            if self.old_serv:
-                backup_file(network)
-                replace(network, self.old_serv, self.new_serv)
-            # Hosts strings
-            host_pattern = '%s%s%s %s.%s\n' % (valip, valtabs, self.old_serv,
-                                               self.old_serv, domain)
-            # hostfile replacements
-            backup_file(hosts)
-            for i in sorted(self.interfaces):
-                ip = self.interfaces[i]['ip']
-                host_record = '%s\t\t%s %s.%s\n' % (ip, self.new_serv,
-                                                    self.new_serv, domain)
-                replace(hosts, host_pattern, host_record)
-            print("Restarting the network service...")
-            if get_release() >= '7':
-                subprocess.call(['systemctl', 'restart', 'network.service'])
-            else:
-                subprocess.call('start_udev')
-                subprocess.call(['service', 'network', 'restart'])
+            self.set_servers()
+            self.prefetched('backups', lambda: None)
+            self.apply_settings()
         except Exception as e:
             sys.exit(e)
 
+    def set_servers(self):
+        """
+        With write_servers, select the reachable nameservers and NTP servers
+        from settings for resolv.conf and ntp.conf (probed, or prefetched);
+        otherwise both files are left alone
+        """
+        if not write_servers:
+            return
+        if self.nameservers is None and os.path.isfile(resolvconf):
+            self.nameservers = self.prefetched('nameservers',
+                                               reachable_nameservers)
+        if self.ntpservers is None and os.path.isfile(ntpconf):
+            self.ntpservers = self.prefetched('ntpservers',
+                                              reachable_ntpservers)
+
+    def managed_files(self):
+        """
+        :return: files written by stage_settings
+        """
+        files = [ifcfg_path + '/ifcfg-%s' % i for i in sorted(self.interfaces)]
+        if self.old_serv:
+            files.append(network)
+        files.append(hosts)
+        if self.nameservers:
+            files.append(resolvconf)
+        if self.ntpservers:
+            files.append(ntpconf)
+        if int(get_release() or 0) <= 6:
+            files.append(persistent)
+        return files
+
+    def stage_settings(self, txn):
+        """
+        Stage the new content of every managed file
+        :param txn: Transaction (or PlanRecorder)
+        """
+        for i in sorted(self.interfaces):
+            with report.phase('write_interfaces'):
+                gen_interface(ifcfg_path + '/ifcfg-%s' % i, i,
+                              self.interfaces[i]['ip'],
+                              self.interfaces[i]['nm'],
+                              self.interfaces[i]['gw'], txn,
+                              self.interfaces[i].get('mac'))
+        if self.old_serv:
+            with report.phase('write_network'):
+                rewrite(network, [(hostname_pattern,
+                                   'HOSTNAME=%s' % self.new_serv)], txn)
+        # hostfile replacements
+        old_serv = (self.old_serv or '').strip()
+        host_records = [(self.interfaces[i]['ip'],
+                         [self.new_serv, '%s.%s' % (self.new_serv, domain)])
+                        for i in sorted(self.interfaces)]
+        with report.phase('write_hosts'):
+            rewrite_hosts(hosts, [old_serv, '%s.%s' % (old_serv, domain)],
+                          host_records, txn)
+        if self.nameservers:
+            update_conf(resolvconf, render_resolvconf, self.nameservers, txn)
+        if self.ntpservers:
+            update_conf(ntpconf, render_ntpconf, self.ntpservers, txn)
+        if int(get_release() or 0) <= 6:
+            # Interface names stay bound to the current MACs without a
+            # udev re-trigger
+            with report.phase('write_rules'):
+                table = dict((i, v['perm_address'])
+                             for i, v in get_interfaces().items())
+                for i in self.interfaces:
+                    table[i] = self.interfaces[i].get('mac') or findmac(i)
+                rules = read_file(persistent) \
+                    if os.path.isfile(persistent) else ''
+                txn.stage(persistent, render_persistent_rules(table, rules))
+
+    def desired_config(self):
+        """
+        :return: target configuration, as recorded in the fingerprint
+        """
+        return {'hostname': self.new_serv, 'domain': domain,
+                'root': root_prefix, 'interfaces': self.interfaces,
+                'nameservers': self.nameservers,
+                'ntpservers': self.ntpservers,
+                'ssh_host_keys': sorted(ssh_host_keys)}
+
+    def apply_settings(self, restart=True):
+        """
+        Write configuration files and restart networking. Only the files
+        whose content changes are backed up, staged and committed together
+        (see Transaction), so an error leaves the system untouched. When the
+        configuration and every managed file match the fingerprint of the
+        last apply, nothing is written or restarted. A new ssh host key set
+        (see ssh_host_keys) is generated meanwhile and committed with the
+        files. The fingerprint is only recorded once the keys are installed,
+        with the interfaces that did not come back up, which the next run
+        reloads again. Errors are raised to the caller.
+        :param restart: restart networking (not at first boot, before the
+                        network is up)
+        """
+        config = self.desired_config()
+        files = [os.path.abspath(f) for f in self.managed_files()]
+        if fingerprint_matches(config, files):
+            print("Configuration unchanged since the last run: "
+                  "nothing to write")
+            return
+        keys = Prefetch(generate_host_keys, self.new_serv) \
+            if ssh_host_keys else None
+        recorder = PlanRecorder()
+        self.stage_settings(recorder)
+        changed = [f for f in recorder.order
+                   if not same_content(f, recorder.content(f))]
+        for cfgfile in changed:
+            backup_file(cfgfile)
+        # A failed key generation aborts before anything is written
+        host_keys = keys.result() if keys else []
+        before = interface_settings(self.interfaces)
+        with Transaction() as txn:
+            for cfgfile in changed:
+                txn.stage(cfgfile, recorder.content(cfgfile))
+            installed = stage_host_keys(txn, host_keys)
+        if keys:
+            remove_other_host_keys(installed)
+        for cfgfile in changed:
+            print('%s written..' % cfgfile)
+        for i in sorted(self.interfaces):
+            print('Interface %s configured..' % i)
+        if ip_pools:
+            record_addresses(self.new_serv,
+                             dict((i, self.interfaces[i]['ip'])
+                                  for i in self.interfaces))
+        failed = []
+        if restart:
+            # Interfaces that did not come up last time are retried
+            pending = (load_fingerprint() or {}).get('pending') or []
+            changed = set(changed_interfaces(before))
+            changed.update(i for i in pending if i in self.interfaces)
+            failed = self.restart_network(sorted(changed))
+        save_fingerprint(config, files, failed)
+
+    def restart_network(self, changed=None):
+        """
+        Bring the new configuration up (skipped for an offline root) and wait
+        for the interfaces to come back with their new address. Unless
+        network_reload is 'service', only the changed interfaces are cycled
+        (ifdown/ifup) and the others are left alone.
+        :param changed: interfaces whose ifcfg settings changed (see
+                        changed_interfaces; default: restart the service)
+        :return: interfaces that did not come back up (ifup failed or not
+                 ready in time)
+        """
+        if root_prefix:
+            print("Offline root %s: network restart skipped" % root_prefix)
+            return []
+        if changed is not None and not changed:
+            print("No interface configuration changed: "
+                  "network reload skipped")
+            return []
+        failed = set()
+        if changed is not None and network_reload != 'service':
+            with report.phase('network_reload'):
+                for i in changed:
+                    print("Reloading interface %s..." % i)
+                    self.runner(['ifdown', i])
+                    if self.runner(['ifup', i])[0] != 0:
+                        print("Warning: ifup %s failed" % i)
+                        failed.add(i)
+        else:
+            changed = sorted(self.interfaces)
+            with report.phase('network_restart'):
+                print("Restarting the network service...")
+                if int(get_release() or 0) >= 7:
+                    self.runner(['systemctl', 'restart', 'network.service'])
+                else:
+                    self.runner(['service', 'network', 'restart'])
+        with report.phase('wait_ready'):
+            self.ready = wait_for_interfaces(
+                dict((i, self.interfaces[i]['ip']) for i in changed))
+        failed.update(i for i in self.ready if self.ready[i] is None)
+        return sorted(failed)
+
 
 def config_interface(preconf, interface):
     """
@@ -463,6 +2517,10 @@ def config_interface(preconf, interface):
     :return:
     """
     print('\nConfiguring Interface: %s' % interface)
+    suggested = None
+    if preconf != 1:
+        suggested = allocate_address(interface, clone.new_serv,
+                                     reserve=False)
     while True:
         if preconf == 1:
             ip = vmconf[interface]['ip']
@@ -470,6 +2528,12 @@ def config_interface(preconf, interface):
             if valid_ip(clone.ip):
                 clone.new_ip = 'IPADDR=%s' % clone.ip
                 break
+        elif suggested:
+            ip = suggested[0]
+            clone.ip = raw_input('Primary IP Address[%s]: ' % ip) or ip
+            if valid_ip(clone.ip):
+                clone.new_ip = 'IPADDR=%s' % clone.ip
+                break
         else:
             clone.ip = raw_input('Primary IP Address: ')
             if valid_ip(clone.ip):
@@ -482,15 +2546,20 @@ def config_interface(preconf, interface):
             if valid_ip(clone.nm):
                 clone.new_nm = 'NETMASK=%s' % clone.nm
                 break
+        elif suggested:
+            nm = suggested[1]
+            clone.nm = raw_input('Primary Netmask[%s]: ' % nm) or nm
+            if valid_ip(clone.nm):
+                clone.new_nm = 'NETMASK=%s' % clone.nm
+                break
         else:
             clone.nm = raw_input('Primary Netmask: ')
             if valid_ip(clone.nm):
                 clone.new_nm = 'NETMASK=%s' % clone.nm
                 break
     # Calculate Gateway based on IP & Netmask
-    prcidr = sum([bin(int(x)).count('1') for x in clone.nm.split('.')])
     if clone.runmode == 0:
-        clone.gw = IPNetwork('%s/%s' % (clone.ip, prcidr))[1].format()
+        clone.gw = default_gateway(clone.ip, clone.nm)
         while True:
             clone.gw = raw_input('Primary Gateway IP[%s]: '
                                  % clone.gw) or clone.gw
@@ -519,10 +2588,9 @@ def config_interface(preconf, interface):
 def main(preconf):
     clone.set_hostname()
     # while True:
-    for i in sorted(get_interfaces()):
+    for i in sorted(clone.prefetched('interfaces', get_interfaces)):
         config_interface(preconf, i)
     print("\n" * 2 + "Saving configuration..")
-    sleep(1)
     with open(script_path + '/vmconf.json', 'w') as j:
         json.dump(clone.interfaces, j, sort_keys=True,
                   indent=4, separators=(',', ': '))
@@ -530,34 +2598,938 @@ def main(preconf):
     clone.confirm_settings()
 
 
-if __name__ == "__main__":
+def set_root(root):
+    """
+    Rebase every managed path from settings onto a guest filesystem root
+    (an unpacked or mounted disk image) for offline re-identification.
+    :param root: guest root directory
+    """
+    global _live_paths, _interfaces, root_prefix
+    global hosts, network, ifcfg_path, persistent, ntpconf, resolvconf
+    global release_file, sshdir, backup_root, fingerprint_file
+    if _live_paths is None:
+        _live_paths = dict(hosts=hosts, network=network, ifcfg_path=ifcfg_path,
+                           persistent=persistent, ntpconf=ntpconf,
+                           resolvconf=resolvconf, release_file=release_file,
+                           sshdir=sshdir, backup_root=backup_root,
+                           fingerprint_file=fingerprint_file)
+    if not os.path.isdir(root):
+        raise ValueError("Root %s is not a directory" % root)
+    rooted = dict((k, os.path.join(root, v.lstrip('/')))
+                  for k, v in _live_paths.items())
+    hosts, network = rooted['hosts'], rooted['network']
+    ifcfg_path, persistent = rooted['ifcfg_path'], rooted['persistent']
+    ntpconf, resolvconf = rooted['ntpconf'], rooted['resolvconf']
+    release_file, sshdir = rooted['release_file'], rooted['sshdir']
+    backup_root = rooted['backup_root']
+    fingerprint_file = rooted['fingerprint_file']
+    root_prefix = root
+    _interfaces = None
+
+
+def guest_path(path):
+    """
+    :param path: managed file path
+    :return: the path as seen by the guest (without the offline root)
+    """
+    if root_prefix:
+        return '/' + os.path.relpath(path, root_prefix)
+    return path
+
+
+def host_path(path):
+    """
+    :param path: path as seen by the guest (see guest_path)
+    :return: the path on this system (rebased onto the offline root)
+    """
+    if root_prefix:
+        return os.path.join(root_prefix, path.lstrip('/'))
+    return path
+
+
+def load_offline_interfaces(manifest):
+    """
+    Build the interface table for a guest root. Interfaces of an image can't
+    be discovered, so each MAC comes from the manifest ("mac") or from the
+    HWADDR of the guest's existing ifcfg-<interface> file.
+    :param manifest: see build_manifest
+    :return: dict = {'interface': {'perm_address': '00:00:00:00:00:00'}
+    """
+    global _interfaces
+    _interfaces = dict()
+    for iface, conf in (manifest.get('interfaces') or {}).items():
+        mac = conf.get('mac') if isinstance(conf, dict) else None
+        cfg_file = ifcfg_path + '/ifcfg-%s' % iface
+        if not mac and os.path.isfile(cfg_file):
+            mac = current_mac(cfg_file)
+        if mac and re.match('^%s$' % valmac, mac):
+            _interfaces[iface] = {'perm_address': mac.lower()}
+    return _interfaces
+
+
+def load_manifest(path):
+    """
+    Load a target configuration file. JSON is always supported, YAML when
+    the PyYAML library is installed.
+    :param path: manifest file
+    :return: manifest data
+    """
+    with open(path, 'r') as f:
+        content = f.read()
+    if path.endswith(('.yml', '.yaml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ValueError("PyYAML is required to read %s" % path)
+        return yaml.safe_load(content)
+    return json.loads(content)
+
+
+def parse_interface_arg(value):
+    """
+    Parse a --interface command line argument
+    :param value: <interface>=<ip>,<netmask>,<gateway> or <interface>=auto
+                  (address from the interface's pool, see allocate_manifest)
+    :return: (interface, {'ip': ip, 'nm': netmask, 'gw': gateway})
+    """
+    iface, sep, conf = value.partition('=')
+    if sep and conf == 'auto':
+        return iface, {'ip': 'auto', 'nm': None, 'gw': None}
+    conf = conf.split(',')
+    if not sep or len(conf) != 3:
+        raise ValueError("Invalid interface argument '%s' "
+                         "(expected <interface>=<ip>,<netmask>,<gateway>)"
+                         % value)
+    return iface, {'ip': conf[0], 'nm': conf[1], 'gw': conf[2]}
+
+
+def build_manifest(args):
+    """
+    Build the target configuration for batch mode from an optional manifest
+    file and command line arguments (command line values take precedence).
+    The manifest is either {"hostname": .., "interfaces": {..}} or a bare
+    vmconf.json (interfaces keyed by name).
+    :param args: parsed command line arguments
+    :return: {'hostname': .., 'interfaces': {..}, 'prepare': ..}
+    """
+    manifest = {'hostname': None, 'interfaces': {}, 'prepare': None}
+    if args.manifest:
+        data = load_manifest(args.manifest)
+        if not isinstance(data, dict):
+            raise ValueError("%s does not contain a configuration object"
+                             % args.manifest)
+        if 'interfaces' in data or 'hostname' in data:
+            manifest['hostname'] = data.get('hostname')
+            manifest['interfaces'] = dict(data.get('interfaces') or {})
+            manifest['prepare'] = data.get('prepare')
+        else:
+            manifest['interfaces'] = dict(data)
+    if args.hostname:
+        manifest['hostname'] = args.hostname
+    for value in args.interface:
+        iface, conf = parse_interface_arg(value)
+        manifest['interfaces'][iface] = conf
+    if args.prepare:
+        manifest['prepare'] = args.prepare
+    return manifest
+
+
+def validate_manifest(manifest, allocate=False):
+    """
+    Validate a complete target configuration before anything is written
+    :param manifest: see build_manifest
+    :param allocate: addresses are still to be allocated (see validate_plan)
+    :return: list of errors (empty when valid)
+    """
+    errors = validate_plan([manifest], allocate)
+    if manifest.get('prepare') not in (None, 'halt', 'reboot'):
+        errors.append("prepare: must be 'halt' or 'reboot'")
+    elif manifest.get('prepare') and root_prefix:
+        errors.append("prepare: not available for an offline root")
+    interfaces = get_interfaces()
+    for iface in sorted(manifest.get('interfaces') or {}):
+        if iface not in interfaces and root_prefix:
+            errors.append("%s: no MAC address in manifest or %s"
+                          % (iface, ifcfg_path + '/ifcfg-%s' % iface))
+        elif iface not in interfaces:
+            errors.append("%s: interface not found on this system" % iface)
+    return errors
+
+
+def batch(manifest, restart=True):
+    """
+    Re-identify this server from a target configuration with no prompts,
+    sleeps or screen clears. Progress messages are written to stderr so that
+    stdout only carries the status.
+    In offline mode (see set_root) the network restart is skipped and the
+    guest's ssh host keys are removed (or replaced, see ssh_host_keys)
+    instead of shutting down (udev net rules are generated for the
+    manifest's MAC addresses).
+    :param manifest: see build_manifest
+    :param restart: restart networking after applying
+    :return: (status dict, exit code; interfaces that did not come back with
+             their address before ready_timeout count as failed)
+    """
+    if root_prefix:
+        load_offline_interfaces(manifest)
+    # Nothing is swept or reserved for an otherwise invalid manifest
+    errors = validate_manifest(manifest, allocate=True)
+    if not errors:
+        allocate_manifest(manifest)
+        errors = validate_manifest(manifest)
+    if errors:
+        return {'status': 'invalid', 'errors': errors}, 2
+    server = ServerClone(headless=True)
+    server.new_serv = manifest['hostname']
+    for iface, conf in manifest['interfaces'].items():
+        server.interfaces[iface] = {'ip': conf['ip'], 'nm': conf['nm'],
+                                    'gw': conf['gw']}
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        server.set_servers()
+        server.apply_settings(restart)
+        if root_prefix:
+            unidentify(remove_ifcfg=False, remove_rules=False,
+                       remove_keys=not ssh_host_keys)
+        elif manifest.get('prepare'):
+            clean_shutdown(manifest['prepare'])
+    except Exception as e:
+        return {'status': 'failed', 'error': str(e)}, 1
+    finally:
+        sys.stdout = stdout
+    if None in server.ready.values():
+        return {'status': 'failed', 'ready': server.ready,
+                'error': 'interfaces not ready after %ss' % ready_timeout}, 1
+    return {'status': 'ok', 'hostname': server.new_serv,
+            'interfaces': sorted(server.interfaces),
+            'ready': server.ready}, 0
+
+
+def fleet_worker(manifest):
+    """
+    Re-identify one guest root of a fleet (runs in a worker process)
+    :param manifest: see build_manifest, plus "root"
+    :return: (status dict, run report of the guest)
+    """
+    global report
+    report = RunReport()
+    try:
+        set_root(manifest.get('root') or '')
+        status, code = batch(manifest)
+    except Exception as e:
+        status = {'status': 'failed', 'error': str(e)}
+    status['root'] = manifest.get('root')
+    return status, report.as_dict()
+
+
+def fleet(manifests, workers=None):
+    """
+    Re-identify many mounted/unpacked guest roots concurrently
+    :param manifests: list of manifests, each with a "root" directory
+    :param workers: size of the process pool (default: fleet_workers)
+    :return: (status dict, exit code). The whole plan is validated first;
+             nothing is touched when it is invalid. 'auto' addresses are
+             allocated here, one guest after the other, and the plan is
+             validated again with them before any worker starts.
+    """
+    import multiprocessing
+    if not isinstance(manifests, list):
+        raise ValueError("A fleet manifest must contain a list of manifests")
+    errors = validate_plan(manifests, allocate=True)
+    if not errors:
+        for manifest in manifests:
+            allocate_manifest(manifest)
+        errors = validate_plan(manifests)
+    if errors:
+        return {'status': 'invalid', 'errors': errors}, 2
+    pool = multiprocessing.Pool(workers or fleet_workers)
+    try:
+        with report.phase('fleet'):
+            results = pool.map(fleet_worker, manifests, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for i, (status, guest_report) in enumerate(results):
+        report.guests['%d:%s' % (i, status['root'])] = guest_report
+    results = [status for status, guest_report in results]
+    failed = [r for r in results if r['status'] != 'ok']
+    return {'status': 'failed' if failed else 'ok',
+            'results': results}, 1 if failed else 0
+
+
+def compile_plan(manifest):
+    """
+    Resolve everything a clone needs ahead of time: the final content of
+    every managed file, the target MAC addresses and the reachable
+    nameservers and NTP servers (see write_servers). apply_plan replays the
+    result with only precondition checks (no discovery, probing or
+    prompts).
+    Interface MACs come from a "mac" key in the manifest (the clone's
+    addresses) or from this system (or the offline root).
+    :param manifest: see build_manifest
+    :return: (plan, list of errors)
+    """
+    if root_prefix:
+        interfaces = load_offline_interfaces(manifest)
+    else:
+        interfaces = get_interfaces()
+    for iface, conf in (manifest.get('interfaces') or {}).items():
+        mac = conf.get('mac') if isinstance(conf, dict) else None
+        if mac and re.match('^%s$' % valmac, mac):
+            interfaces[iface] = {'perm_address': mac.lower()}
+    errors = validate_manifest(manifest, allocate=True)
+    if not errors:
+        allocate_manifest(manifest)
+        errors = validate_manifest(manifest)
+    if errors:
+        return None, errors
+    server = ServerClone(headless=True)
+    server.new_serv = manifest['hostname']
+    for iface, conf in manifest['interfaces'].items():
+        server.interfaces[iface] = {'ip': conf['ip'], 'nm': conf['nm'],
+                                    'gw': conf['gw'],
+                                    'mac': interfaces[iface]['perm_address']}
+    server.set_servers()
+    recorder = PlanRecorder()
+    server.stage_settings(recorder)
+    # Files edited from their current content may only be replaced while
+    # that content is unchanged; ifcfg files are generated from scratch
+    derived = [os.path.abspath(f) for f in
+               (network, hosts, resolvconf, ntpconf)]
+    files = dict()
+    for path in recorder.order:
+        files[guest_path(path)] = {
+            'content': recorder.content(path),
+            'base': file_digest(path) if path in derived else None}
+    return {'version': PLAN_VERSION,
+            'vmclone': __version__,
+            'created': datetime.datetime.now().isoformat(),
+            'hostname': server.new_serv,
+            'interfaces': server.interfaces,
+            'nameservers': server.nameservers or [],
+            'ntpservers': server.ntpservers or [],
+            'files': files}, []
+
+
+def write_plan(manifest, output):
+    """
+    Compile a target configuration into a plan artifact (see compile_plan)
+    :param manifest: see build_manifest
+    :param output: plan file to write
+    :return: (status dict, exit code)
+    """
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        with report.phase('plan'):
+            artifact, errors = compile_plan(manifest)
+    finally:
+        sys.stdout = stdout
+    if errors:
+        return {'status': 'invalid', 'errors': errors}, 2
+    write_atomic(output, json.dumps(artifact, sort_keys=True, indent=4,
+                                    separators=(',', ': ')) + '\n')
+    return {'status': 'ok', 'plan': output,
+            'hostname': artifact['hostname'],
+            'files': sorted(artifact['files']),
+            'nameservers': artifact['nameservers'],
+            'ntpservers': artifact['ntpservers']}, 0
+
+
+def check_plan(artifact):
+    """
+    Cheap preconditions of a plan: format version, every interface present
+    with its planned MAC (not checked for an offline root) and every edited
+    file unchanged since the plan was compiled (or already holding its
+    planned content)
+    :param artifact: see compile_plan
+    :return: list of errors (empty when the plan can be applied)
+    """
+    if not isinstance(artifact, dict) or \
+            artifact.get('version') != PLAN_VERSION:
+        return ["unsupported plan format (expected version %d)"
+                % PLAN_VERSION]
+    errors = []
+    if not root_prefix:
+        interfaces = get_interfaces()
+        for iface in sorted(artifact['interfaces']):
+            mac = artifact['interfaces'][iface]['mac']
+            if iface not in interfaces:
+                errors.append("%s: interface not found on this system"
+                              % iface)
+            elif interfaces[iface]['perm_address'].lower() != mac.lower():
+                errors.append("%s: MAC address %s does not match the "
+                              "planned %s"
+                              % (iface, interfaces[iface]['perm_address'],
+                                 mac))
+    for path in sorted(artifact['files']):
+        base = artifact['files'][path]['base']
+        if not base:
+            continue
+        current = file_digest(host_path(path))
+        planned = artifact['files'][path]['content'].encode('utf-8')
+        if current not in (base, hashlib.sha256(planned).hexdigest()):
+            errors.append("%s: changed since the plan was compiled" % path)
+    return errors
+
+
+def apply_plan(artifact, restart=True):
+    """
+    Replay a plan (see compile_plan): check its preconditions, back up and
+    write every file in one transaction, then restart networking. In
+    offline mode the guest's ssh host keys (unless generated, see
+    ssh_host_keys) and udev net rules (unless the plan generated them) are
+    removed instead.
+    :param artifact: plan data
+    :param restart: restart networking after applying
+    :return: (status dict, exit code; see batch)
+    """
+    with report.phase('preconditions'):
+        errors = check_plan(artifact)
+    if errors:
+        return {'status': 'invalid', 'errors': errors}, 2
+    server = ServerClone(headless=True)
+    server.new_serv = artifact['hostname']
+    server.interfaces = artifact['interfaces']
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        files = sorted(artifact['files'])
+        contents = dict()
+        for path in files:
+            content = artifact['files'][path]['content']
+            if not isinstance(content, str):
+                content = content.encode('utf-8')  # py2 json unicode
+            if not same_content(host_path(path), content):
+                contents[path] = content
+        keys = Prefetch(generate_host_keys, server.new_serv) \
+            if ssh_host_keys and contents else None
+        for path in sorted(contents):
+            backup_file(host_path(path))
+        host_keys = keys.result() if keys else []
+        before = interface_settings(server.interfaces)
+        with Transaction() as txn:
+            for path in sorted(contents):
+                txn.stage(host_path(path), contents[path])
+            installed = stage_host_keys(txn, host_keys)
+        if keys:
+            remove_other_host_keys(installed)
+        for path in files:
+            print('%s %s..' % (path, 'written' if path in contents
+                               else 'unchanged'))
+        if restart:
+            server.restart_network(changed_interfaces(before))
+        if root_prefix:
+            unidentify(remove_ifcfg=False,
+                       remove_rules=guest_path(persistent) not in files,
+                       remove_keys=not ssh_host_keys)
+    except Exception as e:
+        return {'status': 'failed', 'error': str(e)}, 1
+    finally:
+        sys.stdout = stdout
+    if None in server.ready.values():
+        return {'status': 'failed', 'ready': server.ready,
+                'error': 'interfaces not ready after %ss' % ready_timeout}, 1
+    return {'status': 'ok', 'hostname': server.new_serv,
+            'interfaces': sorted(server.interfaces),
+            'ready': server.ready}, 0
+
+
+def open_profiles():
+    """
+    Open the profile store (see profile_store), creating it when missing
+    :return: sqlite3 connection
+    """
+    import sqlite3
+    directory = os.path.dirname(os.path.abspath(profile_store))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    conn = sqlite3.connect(profile_store)
+    for statement in PROFILE_SCHEMA:
+        conn.execute(statement)
+    return conn
+
+
+def read_profiles_csv(path):
+    """
+    Read a fleet CSV file with the columns hostname, interface, mac, ip, nm
+    and gw: one row per interface, the rows of a hostname form its profile
+    :param path: CSV file
+    :return: list of manifests (see build_manifest) with a "mac" per
+             interface, in file order
+    """
+    import csv
+    profiles = dict()
+    order = []
+    with open(path, 'r') as f:
+        reader = csv.DictReader(f)
+        missing = [c for c in PROFILE_COLUMNS
+                   if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError("%s: missing column(s) %s"
+                             % (path, ', '.join(missing)))
+        for row in reader:
+            row = dict((k, (row.get(k) or '').strip())
+                       for k in PROFILE_COLUMNS)
+            if not any(row.values()):
+                continue
+            key = row['hostname'].lower()
+            if key not in profiles:
+                profiles[key] = {'hostname': row['hostname'],
+                                 'interfaces': {}}
+                order.append(key)
+            profiles[key]['interfaces'][row['interface']] = {
+                'ip': row['ip'], 'nm': row['nm'], 'gw': row['gw'],
+                'mac': row['mac'].lower().replace('-', ':')}
+    return [profiles[key] for key in order]
+
+
+def validate_profiles(manifests):
+    """
+    Validate profiles for import: addressing (see validate_plan) plus one
+    valid MAC address per interface, each used once
+    :param manifests: see read_profiles_csv
+    :return: list of errors (empty when valid)
+    """
+    errors = validate_plan(manifests)
+    owners = dict()
+    for manifest in manifests:
+        for iface in sorted(manifest['interfaces']):
+            owner = '%s: %s' % (manifest['hostname'], iface)
+            mac = manifest['interfaces'][iface]['mac']
+            if not re.match('^%s$' % valmac, mac):
+                errors.append("%s: invalid MAC address '%s'" % (owner, mac))
+            elif mac in owners:
+                errors.append("%s: MAC address %s is also used by %s"
+                              % (owner, mac, owners[mac]))
+            else:
+                owners[mac] = owner
+    return errors
+
+
+def import_profiles(path):
+    """
+    Bulk import a fleet CSV file (see read_profiles_csv) into the profile
+    store in one transaction. The whole file is validated first, then with
+    the stored profiles (IP addresses and MACs used once across the store),
+    and nothing is imported when it is invalid; profiles already stored
+    under the same hostname are replaced.
+    :param path: CSV file
+    :return: (status dict, exit code; see batch)
+    """
+    with report.phase('read_profiles'):
+        manifests = read_profiles_csv(path)
+        errors = validate_profiles(manifests)
+    if errors:
+        return {'status': 'invalid', 'errors': errors}, 2
+    hostnames = [(m['hostname'],) for m in manifests]
+    macs = [(conf['mac'], m['hostname']) for m in manifests
+            for conf in m['interfaces'].values()]
+    imported = set(h.lower() for h, in hostnames)
+    conn = open_profiles()
+    try:
+        stored = [json.loads(manifest) for hostname, manifest in
+                  conn.execute("SELECT hostname, manifest FROM profiles")
+                  if hostname.lower() not in imported]
+        errors = validate_plan(stored + manifests)
+        for mac, hostname in macs:
+            row = conn.execute("SELECT hostname FROM profile_macs "
+                               "WHERE mac = ?", (mac,)).fetchone()
+            if row and row[0].lower() not in imported:
+                errors.append("%s: MAC address %s belongs to stored "
+                              "profile %s" % (hostname, mac, row[0]))
+        if errors:
+            return {'status': 'invalid', 'errors': errors}, 2
+        with report.phase('import_profiles'):
+            with conn:
+                conn.executemany("DELETE FROM profile_macs "
+                                 "WHERE hostname = ?", hostnames)
+                conn.executemany("INSERT OR REPLACE INTO profiles "
+                                 "(hostname, manifest) VALUES (?, ?)",
+                                 [(m['hostname'],
+                                   json.dumps(m, sort_keys=True))
+                                  for m in manifests])
+                conn.executemany("INSERT INTO profile_macs (mac, hostname) "
+                                 "VALUES (?, ?)", macs)
+    finally:
+        conn.close()
+    return {'status': 'ok', 'profiles': len(manifests),
+            'store': profile_store}, 0
+
+
+def system_interfaces():
+    """
+    :return: interfaces of this system (see get_interfaces), or of the
+             offline root from the HWADDR of its ifcfg-<interface> files
+    """
+    if not root_prefix:
+        return get_interfaces()
+    table = dict()
+    for cfg_file in glob.glob('%s/ifcfg-*' % ifcfg_path):
+        iface = os.path.basename(cfg_file)[len('ifcfg-'):]
+        mac = (current_mac(cfg_file) or '').strip('"\'')
+        if iface != 'lo' and re.match('^%s$' % valmac, mac):
+            table[iface] = {'perm_address': mac.lower()}
+    return table
+
+
+def find_profile(hostname=None, interfaces=None):
+    """
+    Look up a profile in the store, by hostname or by the MAC addresses of
+    the given interfaces (one indexed lookup per address). Interfaces of a
+    profile found by MAC are renamed after the interface holding the MAC.
+    :param hostname: hostname of the profile
+    :param interfaces: see get_interfaces (default: system_interfaces())
+    :return: manifest (see build_manifest), or None when none matches
+    """
+    if not os.path.isfile(profile_store):
+        return None
+    names = None
+    conn = open_profiles()
+    try:
+        if not hostname:
+            if interfaces is None:
+                interfaces = system_interfaces()
+            names = dict((v['perm_address'].lower(), i)
+                         for i, v in interfaces.items())
+            matches = set()
+            for mac in sorted(names):
+                row = conn.execute("SELECT hostname FROM profile_macs "
+                                   "WHERE mac = ?", (mac,)).fetchone()
+                if row:
+                    matches.add(row[0])
+            if len(matches) > 1:
+                raise ValueError("MAC addresses match several profiles: %s"
+                                 % ', '.join(sorted(matches)))
+            if not matches:
+                return None
+            hostname = matches.pop()
+        row = conn.execute("SELECT manifest FROM profiles "
+                           "WHERE hostname = ?", (hostname,)).fetchone()
+    finally:
+        conn.close()
+    if not row:
+        return None
+    manifest = json.loads(row[0])
+    if names:
+        manifest['interfaces'] = dict(
+            (names.get(conf['mac'], iface), conf)
+            for iface, conf in manifest['interfaces'].items())
+    return manifest
+
+
+def apply_profile(hostname=None, restart=True):
+    """
+    Re-identify this server (or the offline root) with its profile from
+    the store, found by MAC address or hostname, without prompts (see batch)
+    :param hostname: select the profile by hostname instead of MAC
+    :param restart: restart networking after applying
+    :return: (status dict, exit code; see batch)
+    """
+    with report.phase('find_profile'):
+        manifest = find_profile(hostname)
+    if manifest is None:
+        return {'status': 'invalid',
+                'errors': ['no profile for %s in %s'
+                           % (hostname or 'the MAC addresses of this system',
+                              profile_store)]}, 2
+    manifest['prepare'] = None
+    return batch(manifest, restart)
+
+
+def read_cmdline():
+    """
+    Read vmclone.<key>=<value> parameters from the kernel command line
+    :return: dict = {'key': 'value'}
+    """
+    params = dict()
     try:
-        from netaddr import IPNetwork
-    except ImportError:
-        print('Installing python-netaddr library..')
-        netmod = subprocess.Popen(['yum', 'install', 'python-netaddr', '-y'],
-                                  stdout=DEVNULL, stderr=subprocess.STDOUT)
-        if netmod.wait() == 0:
-            from netaddr import IPNetwork
+        for token in read_file(proc_cmdline).split():
+            key, sep, value = token.partition('=')
+            if key.startswith('vmclone.') and sep:
+                params[key[len('vmclone.'):]] = value
+    except IOError:
+        pass
+    return params
+
+
+def load_seed():
+    """
+    Find the target identity of this clone for firstboot. The seed file is
+    the first of: vmclone.seed=<path> on the kernel command line, the
+    seed_files from settings (ie: on a config drive) and vmconf.json when it
+    holds a hostname (the one saved by an interactive clone does not). It is
+    either a plan (see compile_plan) or a batch manifest, which
+    vmclone.hostname=<name> and vmclone.<interface>=<ip>,<netmask>,<gateway>
+    on the kernel command line complete or override. Without either, the
+    profile matching the MAC addresses of this system is taken from the
+    profile store (see find_profile).
+    :return: (plan or manifest, description of the source), (None, None)
+             when this system has no seed
+    """
+    params = read_cmdline()
+    path = params.pop('seed', None)
+    if path and not os.path.isfile(path):
+        raise IOError("Seed %s not found" % path)
+    vmconf = script_path + '/vmconf.json'
+    for candidate in [] if path else seed_files + [vmconf]:
+        if not os.path.isfile(candidate):
+            continue
+        if candidate == vmconf and \
+                'hostname' not in (load_manifest(vmconf) or {}):
+            # Interfaces saved by an interactive clone (ie: of the template
+            # itself), not the identity of this clone
+            continue
+        path = candidate
+        break
+    if path:
+        data = load_manifest(path)
+        if isinstance(data, dict) and 'files' in data and 'version' in data:
+            return data, path
+    elif not params:
+        profile = find_profile()
+        if profile is None:
+            return None, None
+        profile['prepare'] = None
+        return profile, profile_store
+    hostname = params.pop('hostname', None)
+    args = argparse.Namespace(
+        manifest=path, hostname=hostname, prepare=None,
+        interface=['%s=%s' % (k, v) for k, v in sorted(params.items())])
+    manifest = build_manifest(args)
+    manifest['prepare'] = None
+    return manifest, ' + '.join(([path] if path else []) +
+                                (['kernel command line']
+                                 if hostname or params else []))
+
+
+def disable_firstboot():
+    """
+    Disable the firstboot service so that it runs only once
+    """
+    if int(get_release() or 0) >= 7:
+        run_command(['systemctl', 'disable', '%s.service' % firstboot_service])
+    else:
+        run_command(['chkconfig', firstboot_service, 'off'])
+
+
+def firstboot():
+    """
+    Re-identify this clone early at boot, before the network comes up (see
+    firstboot/ for the systemd unit and SysV init script): apply the seed
+    (see load_seed) without a network restart, set the running hostname and
+    disable the service. Without a seed nothing is changed and the service
+    stays enabled (ie: when the template itself boots).
+    :return: (status dict, exit code; see batch)
+    """
+    with report.phase('firstboot'):
+        seed, source = load_seed()
+        if seed is None:
+            return {'status': 'skipped', 'error': 'no seed found'}, 0
+        if 'files' in seed:
+            status, code = apply_plan(seed, restart=False)
         else:
-            minimal_mode = 1
-    os.system("clear")
+            status, code = batch(seed, restart=False)
+        status['seed'] = source
+        if code == 0:
+            run_command(['hostname', status['hostname']])
+            disable_firstboot()
+    return status, code
+
+
+def build_parser():
+    """
+    :return: command line parser (see parse_args)
+    """
+    parser = argparse.ArgumentParser(
+        description='Re-Identify a cloned Linux Virtual Machine '
+                    '(Hostname & Networking). Run without arguments to '
+                    'display the current interfaces.')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--report', metavar='PATH',
+                        help='write a JSON timing report of the run to PATH')
+    commands = parser.add_subparsers(dest='command')
+    commands.add_parser('check', parents=[common],
+                        help='Show available Name servers and NTP servers')
+    commands.add_parser('clone', parents=[common],
+                        help='Re-identify this server (write networking '
+                             'files)')
+    batch_parser = commands.add_parser(
+        'batch', parents=[common],
+        help='Re-identify this server from a manifest or command line '
+             'arguments, without prompts')
+    batch_parser.add_argument('manifest', nargs='?',
+                              help='JSON (or YAML) file, same shape as '
+                                   'vmconf.json plus "hostname"')
+    batch_parser.add_argument('--hostname', help='new hostname')
+    batch_parser.add_argument('--interface', action='append', default=[],
+                              metavar='IFACE=IP,NETMASK,GATEWAY',
+                              help='interface configuration (repeatable; '
+                                   'IFACE=auto: next free address of its '
+                                   'pool)')
+    batch_parser.add_argument('--prepare', choices=['halt', 'reboot'],
+                              help='prepare for cloning after applying')
+    batch_parser.add_argument('--root', metavar='DIR',
+                              help='re-identify the guest filesystem mounted '
+                                   'or unpacked at DIR instead of this '
+                                   'system')
+    plan_parser = commands.add_parser(
+        'plan', parents=[common],
+        help='Resolve a batch manifest ahead of time (file contents, MAC '
+             'addresses, reachable Name and NTP servers) into a plan for '
+             'apply')
+    plan_parser.add_argument('manifest', nargs='?',
+                             help='JSON (or YAML) batch manifest')
+    plan_parser.add_argument('--hostname', help='new hostname')
+    plan_parser.add_argument('--interface', action='append', default=[],
+                             metavar='IFACE=IP,NETMASK,GATEWAY',
+                             help='interface configuration (repeatable; '
+                                  'IFACE=auto: next free address of its '
+                                  'pool)')
+    plan_parser.add_argument('--root', metavar='DIR',
+                             help='compile against the guest filesystem at '
+                                  'DIR')
+    plan_parser.add_argument('--output', metavar='PATH',
+                             default=script_path + '/vmplan.json',
+                             help='plan file (default: vmplan.json)')
+    plan_parser.set_defaults(prepare=None)
+    apply_parser = commands.add_parser(
+        'apply', parents=[common],
+        help='Apply a plan compiled by plan, without discovery or probes')
+    apply_parser.add_argument('plan', nargs='?',
+                              default=script_path + '/vmplan.json',
+                              help='plan file (default: vmplan.json)')
+    apply_parser.add_argument('--root', metavar='DIR',
+                              help='apply to the guest filesystem at DIR')
+    commands.add_parser(
+        'firstboot', parents=[common],
+        help='Apply the seeded identity of this clone at boot, before the '
+             'network comes up, then disable the firstboot service')
+    restore_parser = commands.add_parser(
+        'restore', parents=[common],
+        help='Restore every file backed up by a run (list runs when no run '
+             'is given)')
+    restore_parser.add_argument('run', nargs='?', help='backup run id')
+    restore_parser.add_argument('--root', metavar='DIR',
+                                help='restore into the guest filesystem at '
+                                     'DIR')
+    validate_parser = commands.add_parser(
+        'validate', parents=[common],
+        help='Validate a batch or fleet manifest (IPs, netmasks, gateways, '
+             'duplicates) without touching any host')
+    validate_parser.add_argument('manifest',
+                                 help='JSON (or YAML) batch manifest or list '
+                                      'of manifests')
+    fleet_parser = commands.add_parser(
+        'fleet', parents=[common],
+        help='Re-identify many guest filesystems concurrently')
+    fleet_parser.add_argument('manifest',
+                              help='JSON (or YAML) list of batch manifests, '
+                                   'each with a "root" directory')
+    fleet_parser.add_argument('--workers', type=int,
+                              help='concurrent guests (default: %d)'
+                                   % fleet_workers)
+    import_parser = commands.add_parser(
+        'import', parents=[common],
+        help='Import a fleet CSV file (hostname, interface, mac, ip, nm, gw '
+             'per row) into the profile store in one transaction')
+    import_parser.add_argument('csv', help='fleet CSV file')
+    profile_parser = commands.add_parser(
+        'profile', parents=[common],
+        help='Re-identify this server with its profile from the profile '
+             'store, selected by MAC address, without prompts')
+    profile_parser.add_argument('hostname', nargs='?',
+                                help='select the profile by hostname '
+                                     'instead')
+    profile_parser.add_argument('--root', metavar='DIR',
+                                help='re-identify the guest filesystem at '
+                                     'DIR (MAC addresses from its ifcfg '
+                                     'files)')
+    return parser
+
+
+def parse_args(argv):
+    """
+    Parse command line arguments
+    :param argv: arguments (excluding the script name)
+    :return: argparse namespace
+    """
+    return build_parser().parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args(sys.argv[1:]) if len(sys.argv) > 1 else None
+    if args and args.report:
+        atexit.register(report.save, args.report)
+    if args and args.command == 'validate':
+        try:
+            plan = load_manifest(args.manifest)
+            plan = plan if isinstance(plan, list) else [plan]
+            errors = validate_plan(plan, allocate=True)
+        except (IOError, ValueError) as e:
+            plan, errors = [], [str(e)]
+        print(json.dumps({'status': 'invalid' if errors else 'ok',
+                          'hosts': len(plan), 'errors': errors},
+                         sort_keys=True))
+        sys.exit(2 if errors else 0)
+    if args and args.command == 'import':
+        try:
+            status, code = import_profiles(args.csv)
+        except (IOError, ValueError) as e:
+            status, code = {'status': 'invalid', 'errors': [str(e)]}, 2
+        print(json.dumps(status, sort_keys=True))
+        sys.exit(code)
+    if args and args.command in ('batch', 'fleet', 'plan', 'apply',
+                                 'firstboot', 'profile'):
+        if not os.geteuid() == 0:
+            sys.exit("\nOnly root can run this script\n")
+        try:
+            if args.command == 'fleet':
+                status, code = fleet(load_manifest(args.manifest),
+                                     args.workers)
+            elif args.command == 'firstboot':
+                status, code = firstboot()
+            elif args.command == 'profile':
+                if args.root:
+                    set_root(args.root)
+                status, code = apply_profile(args.hostname)
+            elif args.command == 'apply':
+                if args.root:
+                    set_root(args.root)
+                status, code = apply_plan(load_manifest(args.plan))
+            elif args.command == 'plan':
+                if args.root:
+                    set_root(args.root)
+                status, code = write_plan(build_manifest(args),
+                                          args.output)
+            else:
+                if args.root:
+                    set_root(args.root)
+                status, code = batch(build_manifest(args))
+        except (IOError, ValueError) as e:
+            status, code = {'status': 'invalid', 'errors': [str(e)]}, 2
+        print(json.dumps(status, sort_keys=True))
+        sys.exit(code)
+    clear_screen()
     if not os.geteuid() == 0:
         sys.exit("\nOnly root can run this script\n")
-    if len(sys.argv) == 2:
-        if sys.argv[1] == 'check':
-            if minimal_mode == 0:
-                if dependency_check():
-                    get_nameservers()
-                    get_ntpservers()
+    if args:
+        if args.command == 'restore':
+            if args.root:
+                set_root(args.root)
+            if args.run:
+                restore(args.run)
             else:
-                raw_input('Unable to perform \'check\'\nPress the \'any\' key'
-                          'to exit.')
-                sys.exit()
-        elif sys.argv[1] == 'clone':
-            clone = ServerClone(minimal_mode)
+                list_backups()
+        elif args.command == 'check':
+            get_nameservers(refresh=True)
+            get_ntpservers(refresh=True)
+        elif args.command == 'clone':
+            clone = ServerClone()
+            clone.prefetch()
             try:
-                with open('vmconf.json', 'r') as data:
+                with open(script_path + '/vmconf.json', 'r') as data:
                     print("Previous Configuration Detected. Loading...\n")
                     vmconf = json.load(data)
                     main(1)
@@ -576,8 +3548,6 @@ if __name__ == "__main__":
                 clean_shutdown('halt')
             else:
                 pass
-        else:
-            show_usage()
     else:
         current_interfaces = get_interfaces()
         print("Current detected interfaces:\n")